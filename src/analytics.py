@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+制冰机群运行分析
+将每日定时配置和执行日志加载为NumPy数组，以向量化方式计算开机区间、
+占空比、同时开机数量以及预计API调用量
+"""
+
+import re
+import sys
+import json
+import argparse
+import numpy as np
+import config
+
+MINUTES_PER_DAY = 24 * 60
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# 动作编码：开机为1，关机为0
+ACTION_OPEN = 1
+ACTION_CLOSE = 0
+
+# 执行日志行，例如 "2026-01-01 07:00:03,123 - INFO - Executing Power On: Device 2E:78:..."
+_LOG_PATTERN = re.compile(
+    r"^(\d{4}-\d{2}-\d{2}) (\d{2}:\d{2}:\d{2})[,.]\d+ - \w+ - Executing Power (On|Off): Device (\S+)"
+)
+
+
+class FleetSchedule:
+    """Daily transitions of the whole fleet as flat arrays
+
+    Attributes:
+        device_ids: Device IDs, position is the device index
+        device: Device index of every transition (int32)
+        minute: Minute of day of every transition (int16)
+        action: ACTION_OPEN / ACTION_CLOSE of every transition (int8)
+    Transitions are sorted by (device, minute).
+    """
+
+    def __init__(self, device_ids, device, minute, action):
+        order = np.lexsort((action, minute, device))
+        self.device_ids = list(device_ids)
+        self.device = device[order]
+        self.minute = minute[order]
+        self.action = action[order]
+
+
+class DispatchHistory:
+    """Executed power commands as flat arrays, sorted by (device, time)
+
+    Attributes:
+        device_ids: Device IDs, position is the device index
+        device: Device index of every command (int32)
+        seconds: Timestamp in seconds since the epoch (int64, log-local time)
+        action: ACTION_OPEN / ACTION_CLOSE (int8)
+    """
+
+    def __init__(self, device_ids, device, seconds, action):
+        order = np.lexsort((seconds, device))
+        self.device_ids = list(device_ids)
+        self.device = device[order]
+        self.seconds = seconds[order]
+        self.action = action[order]
+
+
+def _parse_minutes(time_strs):
+    """Convert "HH:MM" strings to minutes of day, skipping malformed entries"""
+    minutes = []
+    for time_str in time_strs:
+        try:
+            hour, minute = map(int, time_str.split(":"))
+        except ValueError:
+            continue
+        if 0 <= hour <= 23 and 0 <= minute <= 59:
+            minutes.append(hour * 60 + minute)
+    return minutes
+
+
+def load_fleet_schedule(schedules):
+    """Build a FleetSchedule from per-device open/close lists
+
+    Args:
+        schedules: Dict of device_id -> {"open": [...], "close": [...]}, as returned
+            by Request.read_daily_controller_times
+
+    Returns:
+        FleetSchedule
+    """
+    device_ids = list(schedules)
+    devices, minutes, actions = [], [], []
+    for index, device_id in enumerate(device_ids):
+        times = schedules[device_id]
+        for action, key in ((ACTION_OPEN, "open"), (ACTION_CLOSE, "close")):
+            parsed = _parse_minutes(times.get(key, []))
+            minutes.extend(parsed)
+            devices.extend([index] * len(parsed))
+            actions.extend([action] * len(parsed))
+
+    return FleetSchedule(
+        device_ids,
+        np.asarray(devices, dtype=np.int32),
+        np.asarray(minutes, dtype=np.int16),
+        np.asarray(actions, dtype=np.int8),
+    )
+
+
+def load_dispatch_log(log_file):
+    """Read executed power commands from the scheduler log
+
+    Args:
+        log_file: Path of ice_maker_scheduler.log
+
+    Returns:
+        DispatchHistory
+    """
+    dates, device_names, actions = [], [], []
+    with open(log_file, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            match = _LOG_PATTERN.match(line)
+            if match:
+                day, clock_time, action, device_id = match.groups()
+                dates.append(f"{day}T{clock_time}")
+                actions.append(ACTION_OPEN if action == "On" else ACTION_CLOSE)
+                device_names.append(device_id)
+
+    device_ids, device = np.unique(np.asarray(device_names, dtype=object), return_inverse=True) \
+        if device_names else (np.asarray([], dtype=object), np.asarray([], dtype=np.int64))
+    seconds = np.asarray(dates, dtype="datetime64[s]").astype(np.int64)
+    return DispatchHistory(
+        device_ids.tolist(),
+        device.astype(np.int32),
+        seconds,
+        np.asarray(actions, dtype=np.int8),
+    )
+
+
+def dispatch_history_from_records(records, timezone="America/Vancouver"):
+    """Build a DispatchHistory from simulate.run_simulation records
+
+    Args:
+        records: (utc_time, sku, device_id, instance, value) tuples
+        timezone: Local timezone the history is expressed in, matches the log files
+    """
+    import pytz
+    tz = pytz.timezone(timezone)
+    power = [r for r in records if r[3] == "powerSwitch"]
+    device_names = [r[2] for r in power]
+    local = [r[0].astimezone(tz).replace(tzinfo=None).isoformat() for r in power]
+
+    device_ids, device = np.unique(np.asarray(device_names, dtype=object), return_inverse=True) \
+        if device_names else (np.asarray([], dtype=object), np.asarray([], dtype=np.int64))
+    return DispatchHistory(
+        device_ids.tolist(),
+        device.astype(np.int32),
+        np.asarray(local, dtype="datetime64[s]").astype(np.int64),
+        np.asarray([r[4] for r in power], dtype=np.int8),
+    )
+
+
+def _next_in_group(group, values, period):
+    """Value of the next element within the same group, wrapping around by period"""
+    following = np.roll(values, -1).astype(np.int64)
+    if len(values) == 0:
+        return following
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    ends = np.r_[starts[1:], len(values)] - 1
+    following[ends] = values[starts].astype(np.int64) + period
+    return following
+
+
+def on_intervals(schedule):
+    """Daily on-windows implied by the schedule
+
+    The schedule repeats every day, so the state at midnight is whatever the
+    last transition of the previous day left behind.
+
+    Returns:
+        tuple: (device, start_minute, end_minute) arrays; end may exceed 1440
+            when a window runs past midnight
+    """
+    nxt = _next_in_group(schedule.device, schedule.minute, MINUTES_PER_DAY)
+    on = schedule.action == ACTION_OPEN
+    return schedule.device[on], schedule.minute[on].astype(np.int64), nxt[on]
+
+
+def redundant_transitions(schedule):
+    """Per-device count of transitions that do not change the power state"""
+    previous = np.roll(schedule.action, 1)
+    if len(schedule.action):
+        starts = np.flatnonzero(np.r_[True, schedule.device[1:] != schedule.device[:-1]])
+        ends = np.r_[starts[1:], len(schedule.action)] - 1
+        previous[starts] = schedule.action[ends]
+    redundant = (previous == schedule.action).astype(np.int64)
+    return np.bincount(schedule.device, weights=redundant,
+                       minlength=len(schedule.device_ids)).astype(np.int64)
+
+
+def daily_on_minutes(schedule):
+    """Scheduled on-time per device per day, in minutes"""
+    device, start, end = on_intervals(schedule)
+    return np.bincount(device, weights=end - start,
+                       minlength=len(schedule.device_ids)).astype(np.int64)
+
+
+def duty_cycle(schedule):
+    """Scheduled fraction of the day each device is on"""
+    return daily_on_minutes(schedule) / MINUTES_PER_DAY
+
+
+def fleet_on_profile(schedule):
+    """Number of devices scheduled on for every minute of the day
+
+    Returns:
+        ndarray: 1440 counts, index is the minute of day
+    """
+    _, start, end = on_intervals(schedule)
+    # 跨午夜的区间拆成两段：[start, 1440) 和 [0, end-1440)
+    delta = np.bincount(start, minlength=MINUTES_PER_DAY + 1).astype(np.int64)
+    delta -= np.bincount(np.minimum(end, MINUTES_PER_DAY), minlength=MINUTES_PER_DAY + 1)
+    wrapped = end > MINUTES_PER_DAY
+    delta[0] += np.count_nonzero(wrapped)
+    delta -= np.bincount(end[wrapped] - MINUTES_PER_DAY, minlength=MINUTES_PER_DAY + 1)
+    return np.cumsum(delta)[:MINUTES_PER_DAY]
+
+
+def dispatch_profile(schedule):
+    """Number of commands the fleet sends in every minute of the day"""
+    return np.bincount(schedule.minute.astype(np.int64), minlength=MINUTES_PER_DAY)
+
+
+def projected_api_calls(schedule, days=1):
+    """Projected control calls per device over the given number of days"""
+    per_day = np.bincount(schedule.device, minlength=len(schedule.device_ids)).astype(np.int64)
+    return per_day * days
+
+
+def history_on_seconds(history, first_day, days):
+    """Actual on-time per device per day reconstructed from executed commands
+
+    Args:
+        history: DispatchHistory
+        first_day: First day to report, "YYYY-MM-DD"
+        days: Number of days
+
+    Returns:
+        ndarray: (devices, days) matrix of on-seconds
+    """
+    n_devices = len(history.device_ids)
+    if n_devices == 0:
+        return np.zeros((0, days), dtype=np.int64)
+
+    t0 = np.datetime64(first_day, "s").astype(np.int64)
+    boundaries = t0 + np.arange(days + 1, dtype=np.int64) * SECONDS_PER_DAY
+
+    # 每台设备的累计开机时间 F(t)，在事件点处取值
+    nxt = np.r_[history.seconds[1:], history.seconds[-1:]]
+    last = np.r_[history.device[1:] != history.device[:-1], True]
+    duration = np.where(last, 0, nxt - history.seconds)
+    is_on = history.action == ACTION_OPEN
+    first = np.r_[True, history.device[1:] != history.device[:-1]]
+    group_start = np.maximum.accumulate(np.where(first, np.arange(len(first)), 0))
+    exclusive = np.cumsum(duration * is_on) - duration * is_on
+    cumulative = exclusive - exclusive[group_start]
+
+    # 将(设备, 时间)编码为单调递增的键，一次searchsorted完成所有查询
+    lo = min(int(history.seconds.min()), int(boundaries[0])) - 1
+    span = max(int(history.seconds.max()), int(boundaries[-1])) - lo + 1
+    keys = history.device.astype(np.int64) * span + (history.seconds - lo)
+    query_device = np.repeat(np.arange(n_devices, dtype=np.int64), days + 1)
+    query_time = np.tile(boundaries, n_devices)
+    idx = np.searchsorted(keys, query_device * span + (query_time - lo), side="right") - 1
+
+    valid = (idx >= 0) & (history.device[np.maximum(idx, 0)] == query_device)
+    safe = np.maximum(idx, 0)
+    value = cumulative[safe] + np.where(is_on[safe], query_time - history.seconds[safe], 0)
+    value = np.where(valid, value, 0).reshape(n_devices, days + 1)
+    return np.diff(value, axis=1)
+
+
+def monthly_totals(daily, first_day):
+    """Sum a (devices, days) matrix into calendar months
+
+    Returns:
+        tuple: (month labels, (devices, months) matrix)
+    """
+    days = daily.shape[1]
+    dates = np.datetime64(first_day, "D") + np.arange(days)
+    months = dates.astype("datetime64[M]")
+    starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+    labels = [str(m) for m in months[starts]]
+    if daily.shape[0] == 0 or days == 0:
+        return labels, np.zeros((daily.shape[0], len(labels)), dtype=daily.dtype)
+    return labels, np.add.reduceat(daily, starts, axis=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='制冰机群定时任务与执行记录分析')
+    parser.add_argument('--config', default=config.daily_control_time_load, help='每日定时任务配置文件')
+    parser.add_argument('--devices', default=None, help='设备清单JSON文件（get_devices返回的data数组），默认为config中的设备')
+    parser.add_argument('--log', default=None, help='调度器执行日志 ice_maker_scheduler.log')
+    parser.add_argument('--from', dest='first_day', default=None, help='执行记录统计开始日期 YYYY-MM-DD')
+    parser.add_argument('--days', type=int, default=30, help='执行记录统计天数')
+    args = parser.parse_args(argv)
+
+    from request import Request
+    times = Request(config.api_key, config.api_key_value).read_daily_controller_times(args.config)
+    if args.devices:
+        with open(args.devices, "r") as f:
+            device_ids = [d["device"] for d in json.load(f)]
+    else:
+        device_ids = [config.device]
+
+    schedule = load_fleet_schedule({device_id: times for device_id in device_ids})
+    on_minutes = daily_on_minutes(schedule)
+    calls = projected_api_calls(schedule)
+    redundant = redundant_transitions(schedule)
+    profile = fleet_on_profile(schedule)
+    bursts = dispatch_profile(schedule)
+
+    print(f"Fleet: {len(device_ids)} device(s), schedule file {args.config}")
+    if len(device_ids) <= 20:
+        for index, device_id in enumerate(device_ids):
+            print(f"  {device_id}: on {on_minutes[index] / 60:.2f} h/day, "
+                  f"duty cycle {on_minutes[index] / MINUTES_PER_DAY:.1%}, "
+                  f"{calls[index]} calls/day, {redundant[index]} redundant transition(s)")
+    print(f"Fleet on-time: {on_minutes.sum() / 60:.1f} h/day, mean duty cycle {on_minutes.mean() / MINUTES_PER_DAY:.1%}")
+    print(f"Peak concurrently on: {profile.max()} device(s) at {int(profile.argmax()) // 60:02d}:{int(profile.argmax()) % 60:02d}")
+    print(f"Projected API calls: {calls.sum()} per day, {calls.sum() * 30} per 30 days")
+    print(f"Largest dispatch burst: {bursts.max()} command(s) at {int(bursts.argmax()) // 60:02d}:{int(bursts.argmax()) % 60:02d}")
+
+    if args.log:
+        history = load_dispatch_log(args.log)
+        if len(history.seconds) == 0:
+            print(f"\nNo executed commands found in {args.log}")
+            return 0
+        first_day = args.first_day or str(np.datetime64(int(history.seconds.min()), "s").astype("datetime64[D]"))
+        daily = history_on_seconds(history, first_day, args.days)
+        labels, monthly = monthly_totals(daily, first_day)
+        print(f"\nExecuted commands: {len(history.seconds)} from {args.log}")
+        for index, device_id in enumerate(history.device_ids):
+            months = ", ".join(f"{label}: {monthly[index, m] / 3600:.1f} h" for m, label in enumerate(labels))
+            print(f"  {device_id}: avg {daily[index].mean() / 3600:.2f} h/day ({months})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+设备能力索引
+根据 get_devices 返回的能力描述建立 (sku, 设备ID) -> 能力实例 -> 允许值 的索引，
+在命令发出前于本地校验，避免无效请求消耗API配额
+"""
+
+
+class CapabilitySpec:
+    """Allowed values of one capability instance
+
+    Attributes:
+        type: Capability type, e.g. devices.capabilities.on_off
+        allowed: frozenset of allowed values, or None when unconstrained
+        fields: For STRUCT capabilities, dict of fieldName -> (allowed, required)
+        range: (min, max) for INTEGER capabilities, or None
+    """
+
+    __slots__ = ("type", "allowed", "fields", "range")
+
+    def __init__(self, capability_type, allowed=None, fields=None, value_range=None):
+        self.type = capability_type
+        self.allowed = allowed
+        self.fields = fields
+        self.range = value_range
+
+
+def _enum_values(options):
+    """Allowed values of an ENUM option list, None if the options carry no values"""
+    values = [option["value"] for option in options or [] if "value" in option]
+    return frozenset(values) if values else None
+
+
+def _parse_capability(capability):
+    parameters = capability.get("parameters") or {}
+    data_type = parameters.get("dataType")
+    if data_type == "ENUM":
+        return CapabilitySpec(capability.get("type"), allowed=_enum_values(parameters.get("options")))
+    if data_type == "STRUCT":
+        fields = {}
+        for field in parameters.get("fields", []):
+            allowed = _enum_values(field.get("options")) if field.get("dataType") == "ENUM" else None
+            fields[field["fieldName"]] = (allowed, bool(field.get("required")))
+        return CapabilitySpec(capability.get("type"), fields=fields)
+    if data_type == "INTEGER":
+        value_range = parameters.get("range") or {}
+        return CapabilitySpec(capability.get("type"),
+                              value_range=(value_range.get("min"), value_range.get("max")))
+    return CapabilitySpec(capability.get("type"))
+
+
+class CapabilityIndex:
+    """Capability lookup built once from the device inventory
+
+    An empty index (inventory not loaded) accepts every command, so the
+    program keeps working with the device from config.py when get_devices fails.
+    """
+
+    def __init__(self):
+        # (sku, 设备ID) -> {能力实例: CapabilitySpec}，None表示不限制
+        self._index = {}
+
+    @classmethod
+    def from_devices(cls, devices):
+        """Build the index from the "data" list of a get_devices response"""
+        index = cls()
+        for device in devices or []:
+            if "capabilities" not in device:
+                # 没有能力描述的设备不做限制
+                index._index[(device.get("sku"), device.get("device"))] = None
+                continue
+            specs = {}
+            for capability in device.get("capabilities", []):
+                # 事件类能力只能上报，不能控制
+                if capability.get("type") == "devices.capabilities.event":
+                    continue
+                specs[capability.get("instance")] = _parse_capability(capability)
+            index._index[(device.get("sku"), device.get("device"))] = specs
+        return index
+
+    def __len__(self):
+        return len(self._index)
+
+    def validate(self, sku, device_id, instance, value):
+        """Check a command against the inventory
+
+        Returns:
+            str: Reason the command is invalid, or None if it may be sent
+        """
+        if not self._index:
+            return None
+        key = (sku, device_id)
+        if key not in self._index:
+            return f"unknown device {sku} {device_id}"
+        specs = self._index[key]
+        if specs is None:
+            return None
+        spec = specs.get(instance)
+        if spec is None:
+            return f"device {device_id} has no capability {instance}"
+
+        if spec.allowed is not None and value not in spec.allowed:
+            return f"{instance}={value!r} not in {sorted(spec.allowed)}"
+
+        if spec.fields is not None:
+            if not isinstance(value, dict):
+                return f"{instance} expects an object with fields {sorted(spec.fields)}"
+            for field_name, (allowed, required) in spec.fields.items():
+                if field_name not in value:
+                    if required:
+                        return f"{instance} is missing required field {field_name}"
+                    continue
+                if allowed is not None and value[field_name] not in allowed:
+                    return f"{instance}.{field_name}={value[field_name]!r} not in {sorted(allowed)}"
+            unknown = set(value) - set(spec.fields)
+            if unknown:
+                return f"{instance} has unknown field(s) {sorted(unknown)}"
+
+        if spec.range is not None:
+            low, high = spec.range
+            if not isinstance(value, int) or (low is not None and value < low) or (high is not None and value > high):
+                return f"{instance}={value!r} outside range [{low}, {high}]"
+        return None
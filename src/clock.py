@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+时钟抽象
+调度器通过时钟对象读取当前时间和休眠，便于在模拟模式下快进时间
+"""
+
+import time
+from datetime import datetime, timedelta
+import pytz
+
+
+class SystemClock:
+    """Wall clock backed by the standard library"""
+
+    def now(self, tz=None):
+        """Return the current time, same semantics as datetime.now(tz)"""
+        return datetime.now(tz)
+
+    def today(self):
+        """Return the current local date"""
+        return self.now().date()
+
+    def sleep(self, seconds):
+        """Block for the given number of seconds"""
+        time.sleep(seconds)
+
+    def wait(self, event, seconds):
+        """Block until event is set or the seconds have passed
+
+        Returns:
+            bool: Whether the event is set
+        """
+        return event.wait(seconds)
+
+
+class VirtualClock:
+    """Manually advanced clock for simulations
+
+    sleep() returns immediately and moves the clock forward, so a scheduler
+    loop driven by this clock replays days of ticks in a fraction of a second.
+    """
+
+    def __init__(self, start, local_timezone="America/Vancouver"):
+        """
+        Args:
+            start: Start time; naive datetimes are interpreted in local_timezone
+            local_timezone: Timezone the simulated host runs in
+        """
+        self.local_tz = pytz.timezone(local_timezone)
+        if start.tzinfo is None:
+            start = self.local_tz.localize(start)
+        self._now_utc = start.astimezone(pytz.UTC)
+        # [(UTC时间, 回调)]，时钟走到该时间时调用
+        self._timers = []
+
+    def now(self, tz=None):
+        """Return the simulated time; naive local time when tz is None"""
+        if tz is None:
+            return self._now_utc.astimezone(self.local_tz).replace(tzinfo=None)
+        return self._now_utc.astimezone(tz)
+
+    def today(self):
+        """Return the simulated local date"""
+        return self.now().date()
+
+    def sleep(self, seconds):
+        """Advance the simulated time without blocking"""
+        self.advance(seconds)
+
+    def wait(self, event, seconds):
+        """Advance the simulated time unless event is already set
+
+        Returns:
+            bool: Whether the event is set
+        """
+        if not event.is_set():
+            self.advance(seconds)
+        return event.is_set()
+
+    def call_at(self, when, callback):
+        """Call callback() once the simulated time reaches when (aware datetime)"""
+        self._timers.append((when.astimezone(pytz.UTC), callback))
+        self._timers.sort(key=lambda timer: timer[0])
+
+    def advance(self, seconds):
+        """Move the clock forward by the given number of seconds and fire due timers"""
+        self._now_utc += timedelta(seconds=seconds)
+        while self._timers and self._timers[0][0] <= self._now_utc:
+            _, callback = self._timers.pop(0)
+            callback()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+自适应并发控制
+根据观测到的API响应时间和限流(429)自动调整同时进行的控制请求数量（AIMD：
+加性增、乘性减），云端空闲时提高吞吐量，云端变慢时在被拒绝之前主动降低并发
+"""
+
+import time
+import threading
+from collections import deque
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on in-flight API calls
+
+    Every call that ran while the limiter was saturated and came back fast
+    raises the limit by 1/limit (about +1 per round trip of calls). A 429, a
+    timeout/connection error or a latency above tolerance x the recent
+    minimum latency cuts the limit by the backoff factor, at most once per
+    round trip: calls started before the last decrease do not cut it again.
+    """
+
+    def __init__(self, initial=2, min_limit=1, max_limit=16, tolerance=2.0, backoff=0.7, window=100):
+        """
+        Args:
+            initial: Starting limit
+            min_limit: Lowest limit
+            max_limit: Highest limit, also the size of the dispatch thread pool
+            tolerance: Latency above tolerance x the baseline counts as congestion
+            backoff: Factor applied to the limit on congestion
+            window: Number of recent latencies the baseline (minimum) is taken from
+        """
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self._limit = float(min(self.max_limit, max(self.min_limit, initial)))
+        self._latencies = deque(maxlen=window)
+        self._inflight = 0
+        self._decreased_at = 0.0
+        self._throttled = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        """Current number of calls allowed in flight"""
+        return int(self._limit)
+
+    def acquire(self):
+        """Wait for a free slot
+
+        Returns:
+            tuple: Token to pass to release()
+        """
+        with self._condition:
+            while self._inflight >= int(self._limit):
+                self._condition.wait()
+            self._inflight += 1
+            # 只有并发已用满时，成功的请求才说明可以提高上限
+            saturated = self._inflight >= int(self._limit)
+        return time.monotonic(), saturated
+
+    def release(self, token, overloaded=False):
+        """Free the slot and adjust the limit from the call's outcome
+
+        Args:
+            token: Value returned by acquire()
+            overloaded: The API throttled the call (429) or it timed out/failed to connect
+        """
+        started, saturated = token
+        latency = time.monotonic() - started
+        with self._condition:
+            self._inflight -= 1
+            baseline = min(self._latencies) if self._latencies else latency
+            if overloaded:
+                # 被拒绝的请求返回得快，不能作为正常延迟的基准
+                self._throttled += 1
+            else:
+                self._latencies.append(latency)
+            if overloaded or latency > baseline * self.tolerance:
+                if started >= self._decreased_at:
+                    self._limit = max(self.min_limit, self._limit * self.backoff)
+                    self._decreased_at = time.monotonic()
+            elif saturated:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+    def summary(self):
+        """Current state for status displays"""
+        with self._condition:
+            return {
+                "limit": int(self._limit),
+                "in_flight": self._inflight,
+                "baseline_ms": round(min(self._latencies) * 1000, 1) if self._latencies else None,
+                "throttled": self._throttled,
+            }
@@ -7,4 +7,19 @@ daily_control_time_load = "dailycontrollertime.txt"
 sku = "H7172"
 device = "2E:78:D0:C9:07:8D:78:A0"
 timezone = "UTC-07:00"  # Vancouver/Mountain Time (UTC-7)
-
+dispatch_window = 30  # Seconds over which commands due at the same time are spread (0 = send at once)
+dispatch_tolerance = 120  # Maximum seconds a command may be delayed by spreading
+command_journal = "command_journal.jsonl"  # Idempotency journal of scheduled commands
+control_socket = "ice_maker_scheduler.sock"  # Unix socket of the running scheduler daemon
+event_subscription = False  # Keep device state from Govee MQTT events (requires paho-mqtt)
+daily_request_limit = 10000  # Govee API requests allowed per key per day
+quota_state_file = "api_quota.json"  # Persisted daily request counters
+rate_limit_per_minute = 60  # Requests per minute allowed per API key
+prewarm_lead = 10  # Seconds before a task check to open connections and validate the API key (0 = off)
+verify_commands = False  # Poll device state after accepted commands and re-issue them if not applied (uses extra API calls)
+max_concurrency = 8  # Upper bound of concurrent control requests per API key, the actual limit adapts to API latency and 429s
+history_file = "command_history.bin"  # Append-only binary history of control command outcomes
+history_per_device = 50  # Recent commands kept in memory per device for status queries
+# Govee accounts in addition to api_key_value; when set, every device of the primary and these accounts is scheduled
+# Example: [{"name": "shop", "api_key_value": "..."}, {"name": "office", "api_key_value": "..."}]
+accounts = []
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+调度器本地控制套接字
+守护进程通过Unix域套接字提供任务入队、列表、取消、立即控制和状态查询接口，
+交互式程序作为轻量客户端与正在运行的调度器共享同一份任务状态
+
+协议：每行一个JSON请求 {"op": ..., ...}，每行一个JSON响应 {"ok": true/false, ...}
+"""
+
+import os
+import json
+import errno
+import socket
+import logging
+import threading
+import socketserver
+from datetime import datetime
+import pytz
+from journal import task_key
+from profiling import timings
+
+logger = logging.getLogger(__name__)
+
+
+def socket_in_use(socket_path):
+    """Whether a process is accepting connections on the socket path
+
+    Returns:
+        bool: False when there is no socket file or it is stale (connection refused)
+    """
+    if not os.path.exists(socket_path):
+        return False
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    probe.settimeout(5)
+    try:
+        probe.connect(socket_path)
+    except OSError as e:
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            return False
+        raise
+    finally:
+        probe.close()
+    return True
+
+
+class ControlError(Exception):
+    """Raised by ControlClient when the daemon rejects a request"""
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    """Serve newline-delimited JSON requests until the client disconnects"""
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+                response = self.server.control.dispatch(request)
+            except (KeyError, ValueError) as e:
+                # 请求参数错误：缺少字段、未知设备或时间格式错误
+                response = {"ok": False, "error": str(e)}
+            except Exception as e:
+                logger.error(f"Control request failed: {e}", exc_info=True)
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ControlServer:
+    """Unix-domain socket API in front of a running scheduler"""
+
+    def __init__(self, pool, socket_path, profiler=None, profile_path=None):
+        """
+        Args:
+            pool: ApiKeyPool whose accounts are driven by the scheduler loop
+            socket_path: Filesystem path of the Unix socket
+            profiler: SamplingProfiler controlled by the "profile" op, None disables the op
+            profile_path: File the collapsed stacks are written to when profiling stops
+        """
+        self.pool = pool
+        self.socket_path = socket_path
+        self.profiler = profiler
+        self.profile_path = profile_path
+        self._server = None
+        self._thread = None
+        self._inode = None
+        self.handlers = {
+            "ping": self._ping,
+            "status": self._status,
+            "list": self._list,
+            "enqueue": self._enqueue,
+            "cancel": self._cancel,
+            "command": self._command,
+            "state": self._state,
+            "timings": self._timings,
+            "profile": self._profile,
+            "history": self._history,
+        }
+
+    def start(self):
+        """Bind the socket and serve requests on a daemon thread
+
+        Raises:
+            RuntimeError: Another scheduler is listening on the socket
+        """
+        if socket_in_use(self.socket_path):
+            raise RuntimeError(f"Another scheduler is already listening on {self.socket_path}")
+        if os.path.exists(self.socket_path):
+            # 上次异常退出留下的套接字文件（连接被拒绝）
+            os.unlink(self.socket_path)
+        self._server = _UnixServer(self.socket_path, _ControlHandler)
+        self._server.control = self
+        os.chmod(self.socket_path, 0o600)
+        # 记录自己的套接字文件，停止时不删除其他进程的
+        self._inode = os.stat(self.socket_path).st_ino
+        self._thread = threading.Thread(target=self._server.serve_forever, name="control-socket", daemon=True)
+        self._thread.start()
+        logger.info(f"Control socket listening on {self.socket_path}")
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        try:
+            if os.stat(self.socket_path).st_ino == self._inode:
+                os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def dispatch(self, request):
+        handler = self.handlers.get(request.get("op"))
+        if handler is None:
+            return {"ok": False, "error": f"unknown op: {request.get('op')}"}
+        return handler(request)
+
+    def _ping(self, request):
+        return {"ok": True, "pid": os.getpid()}
+
+    def _status(self, request):
+        accounts = []
+        for name, ice_maker in self.pool.accounts:
+            accounts.append({
+                "name": name,
+                "last_check": ice_maker.last_check_time.isoformat() if ice_maker.last_check_time else None,
+                "loaded_date": ice_maker.loaded_date.isoformat() if ice_maker.loaded_date else None,
+                "devices": [{"sku": d.get("sku"), "device": d.get("device"), "deviceName": d.get("deviceName")}
+                            for d in (ice_maker.devices or [])],
+                "quota": ice_maker.quota.summary(ice_maker.api_key_value) if ice_maker.quota else None,
+                "concurrency": ice_maker.concurrency.summary() if ice_maker.concurrency else None,
+                "queued": ice_maker.dispatcher.pending() if ice_maker.dispatcher else {},
+                "verification": ice_maker.verifier.summary() if ice_maker.verifier else None,
+            })
+        checks = [account["last_check"] for account in accounts if account["last_check"]]
+        return {
+            "ok": True,
+            "pid": os.getpid(),
+            "now": self.pool.accounts[0][1].clock.now(pytz.UTC).isoformat(),
+            "last_check": max(checks) if checks else None,
+            "tasks": len(self.pool.list_tasks()),
+            "accounts": accounts,
+        }
+
+    def _list(self, request):
+        return {"ok": True, "tasks": self.pool.list_tasks()}
+
+    def _enqueue(self, request):
+        """Queue a one-time task; time is "YYYY-MM-DD HH:MM:SS" in the given timezone"""
+        action = request.get("action")
+        if action not in ("open", "close"):
+            return {"ok": False, "error": f"invalid action: {action}"}
+        timezone = request.get("timezone", "America/Vancouver")
+        local_dt = pytz.timezone(timezone).localize(datetime.strptime(request["time"], "%Y-%m-%d %H:%M:%S"))
+        utc_dt = local_dt.astimezone(pytz.UTC)
+        self.pool.schedule_task(request["sku"], request["device"], action, utc_dt)
+        return {"ok": True, "key": task_key(request["sku"], request["device"], action, utc_dt),
+                "target_time": utc_dt.isoformat()}
+
+    def _cancel(self, request):
+        removed = self.pool.cancel_task(request["key"])
+        return {"ok": removed > 0, "removed": removed,
+                "error": None if removed else f"no task with key {request['key']}"}
+
+    def _state(self, request):
+        """Latest pushed/confirmed device state, no API call"""
+        states = {}
+        tables = {id(ice_maker.state_table): ice_maker.state_table
+                  for _, ice_maker in self.pool.accounts if ice_maker.state_table is not None}
+        for table in tables.values():
+            if request.get("device"):
+                states.setdefault(request["device"], {}).update(table.get(request["device"]) or {})
+            else:
+                states.update(table.snapshot())
+        return {"ok": True, "states": states}
+
+    def _history(self, request):
+        """Recent command outcomes of one device, or the last result code of every device"""
+        histories = {id(ice_maker.history): ice_maker.history
+                     for _, ice_maker in self.pool.accounts if ice_maker.history is not None}
+        if not histories:
+            return {"ok": False, "error": "command history is disabled"}
+        device_id = request.get("device")
+        if not device_id:
+            devices = {}
+            for history in histories.values():
+                devices.update(history.devices())
+            return {"ok": True, "devices": devices}
+        limit = int(request.get("limit", 10))
+        for history in histories.values():
+            status = history.status(device_id, limit=limit)
+            if status is not None:
+                return dict(status, ok=True)
+        return {"ok": False, "error": f"no history for device {device_id}"}
+
+    def _timings(self, request):
+        """Per-phase wall/CPU timings of the running scheduler"""
+        response = {"ok": True, "timings": timings.summary(), "lines": timings.format_summary()}
+        if request.get("reset"):
+            timings.reset()
+        return response
+
+    def _profile(self, request):
+        """Start or stop the sampling profiler; stopping writes the samples to profile_path"""
+        if self.profiler is None:
+            return {"ok": False, "error": "profiling is not available"}
+        action = request.get("action")
+        if action == "start":
+            if not self.profiler.start():
+                return {"ok": False, "error": "profiler already running"}
+            logger.info("Sampling profiler started")
+            return {"ok": True}
+        if action == "stop":
+            # 持有控制锁直到样本写出，期间信号不能重新启动分析
+            with self.profiler.lock:
+                result = self.profiler.stop()
+                if result is None:
+                    return {"ok": False, "error": "profiler is not running"}
+                self.profiler.write(self.profile_path)
+                top = self.profiler.top()
+            logger.info(f"Sampling profiler stopped, {result['samples']} samples written to {self.profile_path}")
+            return dict(result, ok=True, path=self.profile_path, top=top)
+        return {"ok": False, "error": f"invalid action: {action}"}
+
+    def _command(self, request):
+        """Send a control command right away"""
+        action = request.get("action")
+        sku, device_id = request["sku"], request["device"]
+        if action == "open":
+            result = self.pool.open_device(sku, device_id)
+        elif action == "close":
+            result = self.pool.close_device(sku, device_id)
+        elif action == "mode":
+            result = self.pool.set_work_mode(sku, device_id, int(request["mode"]))
+        else:
+            return {"ok": False, "error": f"invalid action: {action}"}
+        return {"ok": True, "result": result}
+
+
+class ControlClient:
+    """Client for ControlServer; keeps one connection open for repeated calls"""
+
+    def __init__(self, socket_path, timeout=30):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+
+    def connect(self):
+        """Open the connection, raises OSError when no daemon is listening"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self._reader = sock.makefile("rb")
+        return self
+
+    @property
+    def connected(self):
+        """False once the connection was closed, e.g. after the daemon went away"""
+        return self._sock is not None
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def call(self, op, **params):
+        """Send one request and return the response dict
+
+        Raises:
+            ControlError: The daemon answered with ok=false
+        """
+        if self._sock is None:
+            self.connect()
+        request = dict(params, op=op)
+        self._sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        line = self._reader.readline()
+        if not line:
+            self.close()
+            raise ConnectionError("Control socket closed by scheduler")
+        response = json.loads(line)
+        if not response.get("ok"):
+            raise ControlError(response.get("error") or response)
+        return response
+
+
+def connect_to_daemon(socket_path):
+    """Return a connected ControlClient, or None when no daemon is running"""
+    if not os.path.exists(socket_path):
+        return None
+    client = ControlClient(socket_path)
+    try:
+        client.connect()
+        client.call("ping")
+    except (OSError, ControlError):
+        client.close()
+        return None
+    return client
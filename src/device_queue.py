@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按设备排序的命令队列
+每台设备一个先进先出队列，同一时间最多执行一条该设备的命令，保证同一台制冰机的
+命令不会乱序（先设模式再开机、先开后关）；不同设备的命令在线程池中并行执行。
+同一能力（如 powerSwitch）有更新的命令入队时，尚未执行的旧命令被取代
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# 被取代的命令返回的结果
+SUPERSEDED_RESULT = {"code": 409, "message": "superseded by a newer command", "superseded": True}
+
+
+class _Command:
+    __slots__ = ("capability", "function", "args", "kwargs", "future")
+
+    def __init__(self, capability, function, args, kwargs):
+        self.capability = capability
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class DeviceDispatcher:
+    """Actor-style dispatcher: one FIFO queue and one worker slot per device"""
+
+    def __init__(self, max_workers=8):
+        """
+        Args:
+            max_workers: Devices served in parallel
+        """
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="device")
+        # 设备ID -> 等待执行的命令
+        self._queues = {}
+        # 正在处理队列的设备
+        self._active = set()
+        self._lock = threading.Lock()
+        self.superseded = 0
+
+    def submit(self, device_id, capability, function, *args, **kwargs):
+        """Queue function(*args, **kwargs) behind the device's earlier commands
+
+        A queued command of the same device and capability that has not
+        started yet is dropped; its future resolves to SUPERSEDED_RESULT.
+
+        Args:
+            device_id: Device the command is for
+            capability: Capability instance the command sets, e.g. powerSwitch
+
+        Returns:
+            Future: Resolves to the function's result
+        """
+        command = _Command(capability, function, args, kwargs)
+        with self._lock:
+            queue = self._queues.setdefault(device_id, deque())
+            stale = [queued for queued in queue if queued.capability == capability]
+            for queued in stale:
+                queue.remove(queued)
+            queue.append(command)
+            self.superseded += len(stale)
+            start = device_id not in self._active
+            if start:
+                self._active.add(device_id)
+        for queued in stale:
+            logger.info(f"Queued {capability} command for device {device_id} superseded by a newer one")
+            if queued.future.set_running_or_notify_cancel():
+                queued.future.set_result(dict(SUPERSEDED_RESULT))
+        if start:
+            self._executor.submit(self._drain, device_id)
+        return command.future
+
+    def pending(self):
+        """Number of queued (not yet started) commands per device"""
+        with self._lock:
+            return {device_id: len(queue) for device_id, queue in self._queues.items() if queue}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _drain(self, device_id):
+        """Run the device's commands one after another until its queue is empty"""
+        while True:
+            with self._lock:
+                queue = self._queues.get(device_id)
+                if not queue:
+                    self._queues.pop(device_id, None)
+                    self._active.discard(device_id)
+                    return
+                command = queue.popleft()
+            if not command.future.set_running_or_notify_cancel():
+                continue
+            try:
+                command.future.set_result(command.function(*command.args, **command.kwargs))
+            except Exception as e:
+                logger.error(f"Command for device {device_id} failed: {e}", exc_info=True)
+                command.future.set_exception(e)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+命令下发计划
+将同一时刻到期的命令分散到一个可配置的时间窗口内发送，避免整个设备群
+在同一分钟集中请求 Govee API
+"""
+
+import hashlib
+from datetime import timedelta
+
+
+class DispatchPlanner:
+    """Spread commands that fall due together across a time window
+
+    Every device gets a deterministic position derived from a hash of its ID,
+    so the same device always lands in the same part of the window and the
+    order is stable across restarts. The batch is split into evenly sized
+    slots and each command is jittered inside its slot, which caps the peak
+    request rate at roughly len(batch) / window.
+    """
+
+    def __init__(self, window=30, tolerance=120, send_cost=2):
+        """
+        Args:
+            window: Seconds over which a batch is spread, 0 disables spreading
+            tolerance: Maximum seconds a command may be sent after the batch starts
+            send_cost: Expected seconds one API call takes, reserved at the end of the window
+        """
+        self.window = max(0, window)
+        self.tolerance = max(0, tolerance)
+        self.send_cost = max(0, send_cost)
+
+    @staticmethod
+    def jitter_fraction(device_id):
+        """Deterministic value in [0, 1) for the device"""
+        digest = hashlib.sha1(str(device_id).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+    def effective_window(self):
+        """Spreading window after reserving room for the last call within tolerance"""
+        return max(0, min(self.window, self.tolerance - self.send_cost))
+
+    def plan(self, batch, start):
+        """Assign a send time to every command of a batch
+
+        Args:
+            batch: List of (priority, sku, device_id, payload) entries; a lower
+                priority is sent earlier, payload is passed through untouched
+            start: datetime at which the batch is picked up
+
+        Returns:
+            list: (send_at, sku, device_id, payload) sorted by send_at
+        """
+        ordered = sorted(batch, key=lambda item: (item[0], self.jitter_fraction(item[2]), item[2]))
+        window = self.effective_window()
+        if len(ordered) <= 1 or window == 0:
+            return [(start, sku, device_id, payload) for _, sku, device_id, payload in ordered]
+
+        slot = window / len(ordered)
+        planned = []
+        for position, (_, sku, device_id, payload) in enumerate(ordered):
+            offset = (position + self.jitter_fraction(device_id)) * slot
+            planned.append((start + timedelta(seconds=offset), sku, device_id, payload))
+        return planned
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+设备事件订阅
+通过 Govee OpenAPI 的 MQTT 事件推送维护内存中的设备状态表，
+调度器和交互程序无需调用API即可读取设备最新状态
+
+需要可选依赖 paho-mqtt：pip install paho-mqtt
+"""
+
+import json
+import logging
+import threading
+from datetime import datetime
+import pytz
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+logger = logging.getLogger(__name__)
+
+GOVEE_MQTT_HOST = "mqtt.openapi.govee.com"
+GOVEE_MQTT_PORT = 8883
+
+
+class DeviceStateTable:
+    """Thread-safe latest-known state per device and capability instance"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 设备ID -> {能力实例: {"value", "updated_at", "source"}}
+        self._states = {}
+
+    def update(self, device_id, instance, value, source="event", at=None):
+        """Record the latest value of a capability instance"""
+        entry = {
+            "value": value,
+            "updated_at": (at or datetime.now(pytz.UTC)).isoformat(),
+            "source": source,
+        }
+        with self._lock:
+            self._states.setdefault(device_id, {})[instance] = entry
+
+    def get(self, device_id, instance=None):
+        """Latest state of a device, or of one capability instance; None if unknown"""
+        with self._lock:
+            states = self._states.get(device_id)
+            if states is None:
+                return None
+            if instance is None:
+                return dict(states)
+            entry = states.get(instance)
+            return dict(entry) if entry else None
+
+    def snapshot(self):
+        """Copy of the whole table"""
+        with self._lock:
+            return {device_id: dict(states) for device_id, states in self._states.items()}
+
+
+def apply_event(state_table, event):
+    """Update the state table from one pushed event message
+
+    Args:
+        state_table: DeviceStateTable
+        event: Decoded message, {"sku", "device", "capabilities": [{"instance", "state"}]}
+
+    Returns:
+        int: Number of capability states applied
+    """
+    device_id = event.get("device")
+    if not device_id:
+        return 0
+    applied = 0
+    for capability in event.get("capabilities", []):
+        instance = capability.get("instance")
+        state = capability.get("state")
+        if instance is None or state is None:
+            continue
+        # 事件类能力的state是列表 [{"name", "value", "message"}]，其余为 {"value": ...}
+        if isinstance(state, list):
+            value = [{"name": s.get("name"), "value": s.get("value"), "message": s.get("message")} for s in state]
+        elif isinstance(state, dict) and "value" in state:
+            value = state["value"]
+        else:
+            value = capability.get("value", state)
+        state_table.update(device_id, instance, value, source="event")
+        applied += 1
+    return applied
+
+
+class EventSubscriber:
+    """MQTT client for Govee OpenAPI device events
+
+    Connects with the API key as username and password and subscribes to
+    GA/<api key>. host/port/use_tls can point at a local broker for testing.
+    """
+
+    def __init__(self, api_key_value, state_table, host=GOVEE_MQTT_HOST, port=GOVEE_MQTT_PORT,
+                 use_tls=True, topic=None):
+        """
+        Args:
+            api_key_value: Govee API key
+            state_table: DeviceStateTable updated from the events
+            host: Broker host
+            port: Broker port
+            use_tls: Connect with TLS (required by the Govee broker)
+            topic: Topic to subscribe, default is GA/<api key>
+        """
+        self.api_key_value = api_key_value
+        self.state_table = state_table
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.topic = topic or f"GA/{api_key_value}"
+        self.connected = threading.Event()
+        self._client = None
+
+    def handle_message(self, payload):
+        """Decode one message payload (bytes or str) and apply it to the state table"""
+        try:
+            event = json.loads(payload)
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ignoring malformed event: {e}")
+            return 0
+        applied = apply_event(self.state_table, event)
+        if applied:
+            logger.info(f"Event for device {event.get('device')}: {applied} state(s) updated")
+        return applied
+
+    def _on_connect(self, client, userdata, flags, *args):
+        # paho-mqtt 1.x: (rc,)；2.x: (reason_code, properties)
+        reason_code = args[0] if args else 0
+        if reason_code == 0:
+            logger.info(f"Event subscription connected to {self.host}:{self.port}")
+            client.subscribe(self.topic)
+            self.connected.set()
+        else:
+            logger.error(f"Event subscription refused: {reason_code}")
+
+    def _on_disconnect(self, client, userdata, *args):
+        self.connected.clear()
+        logger.warning("Event subscription disconnected, paho will reconnect")
+
+    def _on_message(self, client, userdata, message):
+        self.handle_message(message.payload)
+
+    def start(self):
+        """Connect and process events on paho's background thread
+
+        Raises:
+            RuntimeError: paho-mqtt is not installed
+        """
+        if mqtt is None:
+            raise RuntimeError("Event subscription requires paho-mqtt: pip install paho-mqtt")
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        else:
+            client = mqtt.Client()
+        client.username_pw_set(self.api_key_value, self.api_key_value)
+        if self.use_tls:
+            client.tls_set()
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_message = self._on_message
+        client.reconnect_delay_set(min_delay=1, max_delay=120)
+        client.connect_async(self.host, self.port, keepalive=60)
+        client.loop_start()
+        self._client = client
+
+    def stop(self):
+        if self._client is not None:
+            self._client.loop_stop()
+            self._client.disconnect()
+            self._client = None
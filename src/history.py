@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+命令执行历史
+每台设备在内存中保留固定数量的最近命令记录（环形缓冲区：时间、命令、耗时、结果），
+内存占用不随运行时间增长；新记录定期追加到二进制历史文件，文件超过上限时轮转。
+查询单台设备的状态不需要扫描日志，耗时与历史长度无关
+"""
+
+import os
+import struct
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+import pytz
+from clock import SystemClock
+
+logger = logging.getLogger(__name__)
+
+# 文件头，用于识别历史文件格式
+MAGIC = b"IMH1"
+# 记录：时间戳(UTC秒)、类别、能力、值、耗时(毫秒)、结果码、设备ID长度，后接设备ID(UTF-8)
+RECORD = struct.Struct("<dBBhfhB")
+
+# 能力实例编码，未知实例记为 255
+INSTANCES = ("powerSwitch", "workMode")
+UNKNOWN_INSTANCE = 255
+
+KINDS = ("discretionary", "scheduled")
+
+
+def _encode_value(value):
+    """Integer form of a capability value; workMode STRUCT values keep the mode number"""
+    if isinstance(value, dict):
+        value = value.get("workMode", -1)
+    try:
+        return max(-32768, min(32767, int(value)))
+    except (TypeError, ValueError):
+        return -1
+
+
+def record_dict(device_id, record):
+    """Readable form of an in-memory record"""
+    at, kind, instance, value, latency_ms, code = record
+    return {
+        "device": device_id,
+        "at": datetime.fromtimestamp(at, pytz.UTC).isoformat(),
+        "kind": KINDS[kind] if kind < len(KINDS) else str(kind),
+        "instance": INSTANCES[instance] if instance < len(INSTANCES) else "unknown",
+        "value": value,
+        "latency_ms": round(latency_ms, 1),
+        "code": code,
+    }
+
+
+def read_history(path):
+    """Iterate (device_id, record) pairs of a history file in write order
+
+    A truncated last record (crash while writing) is ignored.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a command history file")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            at, kind, instance, value, latency_ms, code, length = RECORD.unpack(header)
+            device = f.read(length)
+            if len(device) < length:
+                return
+            yield device.decode("utf-8"), (at, kind, instance, value, latency_ms, code)
+
+
+class ExecutionHistory:
+    """Per-device ring buffers of recent commands with an append-only file behind them"""
+
+    def __init__(self, path=None, per_device=50, max_bytes=5 * 1024 * 1024, flush_every=100, clock=None):
+        """
+        Args:
+            path: History file, None keeps the history in memory only
+            per_device: Records kept in memory per device
+            max_bytes: The file is rotated to path + ".1" when it grows past this size
+            flush_every: Unwritten records that trigger a write to the file
+            clock: Clock used for record timestamps, default is the system clock
+        """
+        self.path = path
+        self.per_device = per_device
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.clock = clock or SystemClock()
+        self._lock = threading.Lock()
+        # 串行化写文件：轮转、写文件头和追加必须一起完成
+        self._write_lock = threading.Lock()
+        # 设备ID -> deque(记录)，记录为 (时间戳, 类别, 能力, 值, 耗时毫秒, 结果码)
+        self._recent = {}
+        # 设备ID -> [记录总数, 失败数]
+        self._counts = {}
+        # 尚未写入文件的 (设备ID, 记录)
+        self._unwritten = []
+        if path is not None:
+            # 轮转后的旧文件在前，保证每台设备保留的是最新的记录
+            for existing in (f"{path}.1", path):
+                if os.path.exists(existing):
+                    self.load(existing)
+
+    def load(self, path, device_id=None):
+        """Fill the ring buffers from a history file
+
+        Args:
+            path: History file
+            device_id: Only load this device's records
+
+        Returns:
+            int: Number of records loaded
+        """
+        loaded = 0
+        try:
+            with self._lock:
+                for record_device, record in read_history(path):
+                    if device_id is None or record_device == device_id:
+                        self._remember(record_device, record)
+                        loaded += 1
+        except (OSError, ValueError) as e:
+            logger.warning(f"Command history {path} not loaded: {e}")
+        return loaded
+
+    def _remember(self, device_id, record):
+        recent = self._recent.get(device_id)
+        if recent is None:
+            recent = self._recent[device_id] = deque(maxlen=self.per_device)
+            self._counts[device_id] = [0, 0]
+        recent.append(record)
+        counts = self._counts[device_id]
+        counts[0] += 1
+        if record[5] != 200:
+            counts[1] += 1
+
+    def record(self, device_id, instance, value, latency, code, scheduled=False):
+        """Add one command outcome
+
+        Args:
+            device_id: Device ID
+            instance: Capability instance, e.g. powerSwitch
+            value: Value that was sent
+            latency: Seconds the command took, rate limiter waits included
+            code: Result code, including local 400/409/429 results
+            scheduled: The command came from a scheduled task
+        """
+        record = (
+            self.clock.now(pytz.UTC).timestamp(),
+            1 if scheduled else 0,
+            INSTANCES.index(instance) if instance in INSTANCES else UNKNOWN_INSTANCE,
+            _encode_value(value),
+            latency * 1000.0,
+            code if isinstance(code, int) else -1,
+        )
+        with self._lock:
+            self._remember(device_id, record)
+            self._unwritten.append((device_id, record))
+            flush_now = self.path is not None and len(self._unwritten) >= self.flush_every
+        if flush_now:
+            self.flush()
+
+    def status(self, device_id, limit=10):
+        """Latest command and recent history of one device
+
+        Returns:
+            dict: {"device", "last", "recent" (newest first, at most limit), "total", "failures"},
+                None if the device has no history
+        """
+        with self._lock:
+            recent = self._recent.get(device_id)
+            if not recent:
+                return None
+            newest = [recent[-index] for index in range(1, min(limit, len(recent)) + 1)]
+            total, failures = self._counts[device_id]
+        return {
+            "device": device_id,
+            "last": record_dict(device_id, newest[0]),
+            "recent": [record_dict(device_id, record) for record in newest],
+            "total": total,
+            "failures": failures,
+        }
+
+    def devices(self):
+        """Devices with history and their last result code"""
+        with self._lock:
+            return {device_id: recent[-1][5] for device_id, recent in self._recent.items() if recent}
+
+    def flush(self):
+        """Append the unwritten records to the history file
+
+        Returns:
+            int: Number of records written
+        """
+        if self.path is None:
+            return 0
+        with self._write_lock:
+            with self._lock:
+                pending, self._unwritten = self._unwritten, []
+            if not pending:
+                return 0
+            data = bytearray()
+            for device_id, record in pending:
+                device = device_id.encode("utf-8")[:255]
+                data += RECORD.pack(*record, len(device))
+                data += device
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) + len(data) > self.max_bytes:
+                    os.replace(self.path, f"{self.path}.1")
+                new_file = not os.path.exists(self.path)
+                with open(self.path, "ab") as f:
+                    if new_file:
+                        f.write(MAGIC)
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                logger.warning(f"Failed to write command history: {e}")
+                # 下次再写；文件持续不可写时只保留有限数量，内存不会增长
+                with self._lock:
+                    self._unwritten[:0] = pending[-self.flush_every * 10:]
+                return 0
+            return len(pending)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+命令日志（幂等键）
+每条定时命令在发送前写入稳定的幂等键，完成后追加完成记录；
+重试和进程重启后复用同一个 requestId，已完成的命令不会再次发送
+"""
+
+import os
+import json
+import uuid
+import logging
+import threading
+from datetime import datetime, timedelta
+import pytz
+from clock import SystemClock
+
+logger = logging.getLogger(__name__)
+
+# 生成 requestId 的命名空间，保证同一个幂等键总是得到同一个 requestId
+REQUEST_ID_NAMESPACE = uuid.UUID("6f1c2f4e-8a3b-5d7e-9c1a-2b4d6e8f0a13")
+
+STATE_PENDING = "pending"
+STATE_DONE = "done"
+
+
+# 幂等键中目标时间(UTC)的格式
+KEY_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def task_key(sku, device_id, action_type, target_time_utc):
+    """Stable idempotency key of one scheduled dispatch"""
+    return f"{sku}|{device_id}|{action_type}|{target_time_utc.astimezone(pytz.UTC).strftime(KEY_TIME_FORMAT)}"
+
+
+def request_id_for(key):
+    """Deterministic Govee requestId for an idempotency key"""
+    return str(uuid.uuid5(REQUEST_ID_NAMESPACE, key))
+
+
+class CommandJournal:
+    """Append-only JSON-lines journal of scheduled dispatches
+
+    Each line is {"key", "request_id", "state", "at"}; the last line for a key
+    wins. A key is written as pending before the command is sent and as done
+    once the API accepted it.
+    """
+
+    def __init__(self, path, retention_days=7, clock=None):
+        """
+        Args:
+            path: Journal file path
+            retention_days: Entries older than this are dropped when the journal is opened
+                and on the first write of every UTC day
+            clock: Clock used for entry timestamps, default is the system clock
+        """
+        self.path = path
+        self.clock = clock or SystemClock()
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+        # 幂等键 -> 最新记录
+        self._entries = {}
+        # 上次清理过期记录的UTC日期
+        self._compacted_on = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 进程崩溃时可能留下半行，忽略即可
+                    logger.warning(f"Skipping corrupt journal line: {line[:80]}")
+                    continue
+                self._entries[entry["key"]] = entry
+        self._compact()
+
+    def _compact(self):
+        """Rewrite the journal without entries past the retention period"""
+        cutoff = self.clock.now(pytz.UTC) - timedelta(days=self.retention_days)
+        kept = {key: entry for key, entry in self._entries.items()
+                if datetime.strptime(entry["at"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.UTC) >= cutoff}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in kept.values():
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._entries = kept
+        self._compacted_on = self.clock.now(pytz.UTC).date()
+
+    def _compact_daily(self):
+        """Drop expired entries once per UTC day, so a long-running daemon's journal stays bounded"""
+        if self._compacted_on == self.clock.now(pytz.UTC).date():
+            return
+        try:
+            self._compact()
+        except OSError as e:
+            logger.warning(f"Journal compaction failed, retrying with the next write: {e}")
+
+    def _append(self, entry):
+        self._compact_daily()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._entries[entry["key"]] = entry
+
+    def state(self, key):
+        """Return STATE_PENDING, STATE_DONE or None for an unknown key"""
+        entry = self._entries.get(key)
+        return entry["state"] if entry else None
+
+    def is_done(self, key):
+        return self.state(key) == STATE_DONE
+
+    def begin(self, key):
+        """Persist the key as pending and return the requestId to send
+
+        A key that is already pending keeps its requestId, so a retry after a
+        timeout or crash is recognisable as the same command.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry["request_id"]
+            request_id = request_id_for(key)
+            self._append({
+                "key": key,
+                "request_id": request_id,
+                "state": STATE_PENDING,
+                "at": self.clock.now(pytz.UTC).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            })
+            return request_id
+
+    def complete(self, key):
+        """Record that the command for key was accepted by the API"""
+        with self._lock:
+            entry = self._entries.get(key)
+            request_id = entry["request_id"] if entry else request_id_for(key)
+            self._append({
+                "key": key,
+                "request_id": request_id,
+                "state": STATE_DONE,
+                "at": self.clock.now(pytz.UTC).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            })
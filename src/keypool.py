@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多账号API密钥池
+每个Govee账号对应一个Request实例（独立的连接池、限速器和配额计数），
+设备按所属账号路由，多个账号可以在同一个调度进程中并行运行
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ApiKeyPool:
+    """Route devices to the Request of the account that owns them"""
+
+    def __init__(self):
+        # [(账号名称, Request)]
+        self.accounts = []
+        # 设备ID -> Request
+        self._routes = {}
+
+    def add(self, name, ice_maker, device_ids=None):
+        """Register an account
+
+        Args:
+            name: Display name of the account
+            ice_maker: Request bound to the account's API key
+            device_ids: Devices known to belong to the account before its inventory is loaded
+        """
+        self.accounts.append((name, ice_maker))
+        for device_id in device_ids or []:
+            self._routes[device_id] = ice_maker
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def refresh(self, force=False):
+        """Load the accounts' inventories and rebuild the device routes
+
+        Args:
+            force: Also reload accounts whose device list is already cached
+
+        Returns:
+            int: Number of accounts whose device list is available
+        """
+        available = 0
+        for name, ice_maker in self.accounts:
+            if (ice_maker.devices and not force) or ice_maker.refresh_inventory():
+                available += 1
+                for device in ice_maker.devices or []:
+                    owner = self._routes.get(device["device"])
+                    if owner is not None and owner is not ice_maker:
+                        logger.warning(f"Device {device['device']} is listed by several accounts, using {name}")
+                    self._routes[device["device"]] = ice_maker
+            else:
+                logger.warning(f"Device list unavailable for account {name}")
+        return available
+
+    def route(self, device_id):
+        """Request of the account owning the device
+
+        Raises:
+            KeyError: The device is unknown and there is more than one account
+        """
+        ice_maker = self._routes.get(device_id)
+        if ice_maker is not None:
+            return ice_maker
+        if len(self.accounts) == 1:
+            return self.accounts[0][1]
+        raise KeyError(f"No account owns device {device_id}")
+
+    def devices(self):
+        """All inventory devices as (account name, Request, device dict)"""
+        return [(name, ice_maker, device)
+                for name, ice_maker in self.accounts for device in ice_maker.devices or []]
+
+    # 手动命令与定时命令进入同一个按设备排序的队列
+
+    def open_device(self, sku, device_id):
+        ice_maker = self.route(device_id)
+        return ice_maker.submit_ordered(device_id, "powerSwitch", ice_maker.open_device, sku, device_id).result()
+
+    def close_device(self, sku, device_id):
+        ice_maker = self.route(device_id)
+        return ice_maker.submit_ordered(device_id, "powerSwitch", ice_maker.close_device, sku, device_id).result()
+
+    def set_work_mode(self, sku, device_id, mode):
+        ice_maker = self.route(device_id)
+        return ice_maker.submit_ordered(device_id, "workMode", ice_maker.set_work_mode, sku, device_id, mode).result()
+
+    def schedule_task(self, sku, device_id, action_type, target_time_utc):
+        self.route(device_id).schedule_task(sku, device_id, action_type, target_time_utc)
+
+    def list_tasks(self):
+        return [task for _, ice_maker in self.accounts for task in ice_maker.list_tasks()]
+
+    def cancel_task(self, key):
+        return sum(ice_maker.cancel_task(key) for _, ice_maker in self.accounts)
+
+    def prewarm_for_check(self, check_time_utc):
+        """Pre-warm every account that has commands due at the next check"""
+        for name, ice_maker in self.accounts:
+            try:
+                ice_maker.prewarm_for_check(check_time_utc)
+            except Exception as e:
+                logger.warning(f"Pre-warm failed for account {name}: {e}")
+    
+    def check_scheduled_tasks(self):
+        """Run every account's task check in parallel, one worker per account"""
+        if len(self.accounts) == 1:
+            self.accounts[0][1].check_scheduled_tasks()
+            return
+        with ThreadPoolExecutor(max_workers=len(self.accounts), thread_name_prefix="account") as executor:
+            futures = [(name, executor.submit(ice_maker.check_scheduled_tasks)) for name, ice_maker in self.accounts]
+            for name, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Task check failed for account {name}: {e}", exc_info=True)
@@ -5,6 +5,13 @@ import sys
 import os
 from datetime import datetime
 from request import Request
+from dispatch import DispatchPlanner
+from journal import CommandJournal
+from control_socket import connect_to_daemon, ControlError
+from quota import QuotaAccountant
+from schedule import normalize_schedule
+from worker import SchedulerWorker
+from concurrency import AdaptiveConcurrencyLimiter
 import config
 import pytz
 
@@ -62,6 +69,86 @@ def format_time_with_all_timezones(time_str, from_timezone):
             "shanghai": "Format error"
         }
 
+def choose_task_to_cancel(tasks, from_timezone):
+    """Print a task list (dicts from list_tasks) and ask for a task to cancel
+    
+    Returns:
+        str: Key of the task to cancel, or None
+    """
+    if not tasks:
+        print("No scheduled tasks")
+        return None
+    local_tz = pytz.timezone(from_timezone)
+    for number, task in enumerate(tasks, 1):
+        target = datetime.fromisoformat(task["target_time"])
+        print(f"{number}. {task['action']} {task['sku']} {task['device']} at "
+              f"{target.astimezone(local_tz).strftime('%Y-%m-%d %H:%M')} ({from_timezone})"
+              f"{' [' + task['state'] + ']' if task['state'] else ''}")
+    cancel_choice = input("Enter task number to cancel (press Enter to skip): ")
+    if not cancel_choice.strip():
+        return None
+    try:
+        return tasks[int(cancel_choice) - 1]["key"]
+    except (ValueError, IndexError):
+        print("Invalid task number")
+        return None
+
+def call_daemon(daemon, op, **params):
+    """Call the scheduler daemon, printing failures instead of raising them
+    
+    A lost connection closes the client; the menu then continues in local mode.
+    
+    Returns:
+        dict: Response, or None if the call failed
+    """
+    try:
+        return daemon.call(op, **params)
+    except ControlError as e:
+        print(f"Scheduler daemon rejected the request: {e}")
+    except OSError as e:
+        print(f"Lost connection to the scheduler daemon ({e}), continuing in local mode")
+        daemon.close()
+    return None
+
+def open_local_state(ice_maker):
+    """Attach the command journal and quota counters used when no daemon is running
+    
+    A running daemon owns these files, so they are only opened in local mode.
+    """
+    ice_maker.journal = CommandJournal(config.command_journal)
+    ice_maker.quota = QuotaAccountant(daily_limit=config.daily_request_limit, state_file=config.quota_state_file)
+
+def show_daemon_tasks(daemon, from_timezone):
+    """Display the running scheduler's status and task list, optionally cancel a task"""
+    status = call_daemon(daemon, "status")
+    if status is None:
+        return
+    print(f"\nScheduler daemon PID {status['pid']}, last check: {status['last_check'] or 'not yet'}")
+    response = call_daemon(daemon, "list")
+    if response is None:
+        return
+    key = choose_task_to_cancel(response["tasks"], from_timezone)
+    if key and call_daemon(daemon, "cancel", key=key) is not None:
+        print("Task cancelled")
+
+def show_background_tasks(ice_maker, worker, from_timezone):
+    """Display the background scheduler's task list, optionally cancel a task or stop it
+    
+    Returns:
+        bool: True if the scheduler was stopped
+    """
+    last_check = ice_maker.last_check_time
+    print(f"\nBackground scheduler running, last check: {last_check.strftime('%H:%M:%S') + ' UTC' if last_check else 'not yet'}")
+    key = choose_task_to_cancel(ice_maker.list_tasks(), from_timezone)
+    if key and ice_maker.cancel_task(key):
+        print("Task cancelled")
+    if input("Stop the background scheduler? (y/n): ").lower() == 'y':
+        print("Stopping scheduler, waiting for the current check to finish...")
+        worker.stop()
+        print("Scheduler stopped")
+        return True
+    return False
+
 def main():
     # Read API key and device info from config file
     api_key = config.api_key
@@ -87,8 +174,21 @@ def main():
     print(f"{timezone} Time: {now_local.strftime('%H:%M:%S')}")
     print(f"Shanghai Time (UTC+8): {now_china.strftime('%H:%M:%S')}")
     
-    # Initialize request object
-    ice_maker = Request(api_key, api_key_value)
+    # Use the running scheduler daemon if there is one
+    socket_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), config.control_socket)
+    daemon = connect_to_daemon(socket_path)
+    if daemon:
+        print(f"Connected to running scheduler daemon ({socket_path})")
+    
+    # Initialize request object; journal and quota belong to the daemon while it runs
+    planner = DispatchPlanner(window=config.dispatch_window, tolerance=config.dispatch_tolerance)
+    # Manual and scheduled commands share the per-device queues, so they cannot overtake each other
+    ice_maker = Request(api_key, api_key_value, dispatch_planner=planner,
+                        concurrency=AdaptiveConcurrencyLimiter(max_limit=config.max_concurrency))
+    if not daemon:
+        open_local_state(ice_maker)
+    # Background scheduler, started from option 6
+    worker = SchedulerWorker(ice_maker, from_timezone=from_timezone)
     
     # Get device list
     devices_result = ice_maker.get_devices()
@@ -135,13 +235,22 @@ def main():
     
     # Demo features
     while True:
+        if daemon is not None and not daemon.connected:
+            daemon = None
+            open_local_state(ice_maker)
+        
         print("\nIce Maker Control System")
         print("1. Power On Device")
         print("2. Power Off Device")
         print("3. Set Work Mode")
         print("4. Set One-time Scheduled Task")
         print("5. View Daily Scheduled Tasks")
-        print("6. Start Task Scheduler (includes daily scheduling)")
+        if daemon:
+            print("6. View / Cancel Scheduler Daemon Tasks")
+        elif worker.running:
+            print("6. View / Cancel / Stop Background Scheduler Tasks")
+        else:
+            print("6. Start Task Scheduler (includes daily scheduling)")
         print("7. View Current Configuration")
         print("8. Modify API Key")
         print("0. Exit")
@@ -149,19 +258,35 @@ def main():
         choice = input("Select operation: ")
         
         if choice == "1":
-            result = ice_maker.open_device(sku, device_id)
-            print(f"Power On result: {result}")
+            if daemon:
+                response = call_daemon(daemon, "command", sku=sku, device=device_id, action="open")
+                result = response["result"] if response else None
+            else:
+                result = ice_maker.submit_ordered(device_id, "powerSwitch", ice_maker.open_device, sku, device_id).result()
+            if result is not None:
+                print(f"Power On result: {result}")
             
         elif choice == "2":
-            result = ice_maker.close_device(sku, device_id)
-            print(f"Power Off result: {result}")
+            if daemon:
+                response = call_daemon(daemon, "command", sku=sku, device=device_id, action="close")
+                result = response["result"] if response else None
+            else:
+                result = ice_maker.submit_ordered(device_id, "powerSwitch", ice_maker.close_device, sku, device_id).result()
+            if result is not None:
+                print(f"Power Off result: {result}")
             
         elif choice == "3":
             print("Work modes: 1-Large Ice, 2-Medium Ice, 3-Small Ice")
             mode = int(input("Select work mode: "))
             if mode in [1, 2, 3]:
-                result = ice_maker.set_work_mode(sku, device_id, mode)
-                print(f"Set work mode result: {result}")
+                if daemon:
+                    response = call_daemon(daemon, "command", sku=sku, device=device_id, action="mode", mode=mode)
+                    result = response["result"] if response else None
+                else:
+                    result = ice_maker.submit_ordered(device_id, "workMode", ice_maker.set_work_mode,
+                                                      sku, device_id, mode).result()
+                if result is not None:
+                    print(f"Set work mode result: {result}")
             else:
                 print("Invalid work mode")
                 
@@ -191,8 +316,14 @@ def main():
                     datetime.strptime(target_time, "%Y-%m-%d %H:%M:%S")
                 
                 # Set scheduled task
-                ice_maker.schedule_with_timezone(sku, device_id, action_type, target_time, from_timezone=from_timezone)
-                print("Scheduled task set")
+                if daemon:
+                    response = call_daemon(daemon, "enqueue", sku=sku, device=device_id, action=action_type,
+                                           time=target_time, timezone=from_timezone)
+                    if response is not None:
+                        print(f"Scheduled task queued in daemon: {response['key']}")
+                else:
+                    ice_maker.schedule_with_timezone(sku, device_id, action_type, target_time, from_timezone=from_timezone)
+                    print("Scheduled task set")
             except ValueError:
                 print("Invalid time format, please use HH:MM or YYYY-MM-DD HH:MM:SS format")
                 
@@ -215,6 +346,13 @@ def main():
             
             print(f"\nNote: These times are configured in {timezone} ({from_timezone}) format, the program will automatically convert them to various timezone times")
             
+            # Report entries the scheduler will drop
+            issues = normalize_schedule(daily_times['open'], daily_times['close'])['issues']
+            if issues:
+                print("Schedule issues (these entries are ignored by the scheduler):")
+                for issue in issues:
+                    print(f"  - {issue}")
+            
             # Ask whether to modify the config file
             edit_choice = input("\nModify scheduled task configuration? (y/n): ")
             if edit_choice.lower() == 'y':
@@ -241,8 +379,14 @@ def main():
                 except Exception as e:
                     print(f"Failed to update configuration file: {e}")
                 
+        elif choice == "6" and daemon:
+            show_daemon_tasks(daemon, from_timezone)
+            
+        elif choice == "6" and worker.running:
+            show_background_tasks(ice_maker, worker, from_timezone)
+            
         elif choice == "6":
-            print("Starting task scheduler, including daily scheduled tasks, press Ctrl+C to stop")
+            print("Starting task scheduler in the background, including daily scheduled tasks")
             # First display current configuration
             daily_times = ice_maker.read_daily_controller_times(daily_control_time_file)
             print("\nDaily Scheduled Tasks:")
@@ -262,8 +406,9 @@ def main():
             # Set up daily tasks for current device
             ice_maker.setup_daily_tasks(sku, device_id, from_timezone=from_timezone)
             
-            # Start scheduler
-            ice_maker.start_scheduler()
+            # Start scheduler, the menu stays available
+            worker.start()
+            print("Scheduler running in the background, select 6 again to view tasks or stop it")
             
         elif choice == "7":
             # Display current configuration
@@ -277,6 +422,26 @@ def main():
             print(f"Timezone Setting: {timezone} ({from_timezone})")
             print(f"Scheduled Task Config File: {daily_control_time_file}")
             
+            # Display today's API usage
+            if daemon:
+                status = call_daemon(daemon, "status")
+                usages = [account["quota"] for account in status["accounts"] if account["quota"]] if status else []
+            else:
+                usages = [ice_maker.quota.summary(api_key_value)]
+            for usage in usages:
+                print(f"\nAPI Usage Today (key {usage['key']}, UTC {usage['day']}): {usage['used']}/{usage['limit']}, "
+                      f"reserved for scheduled tasks: {usage['reserved']}")
+            
+            # Display live device state kept by the scheduler daemon
+            response = call_daemon(daemon, "state", device=device_id) if daemon else None
+            if response is not None:
+                states = response["states"].get(device_id) or {}
+                print("\nDevice State (from scheduler daemon):")
+                if not states:
+                    print("  No state received yet")
+                for instance, entry in states.items():
+                    print(f"  {instance}: {entry['value']} ({entry['source']}, {entry['updated_at']})")
+            
             # Display current time in different timezones
             now_utc = datetime.now(pytz.UTC)
             now_local = now_utc.astimezone(pytz.timezone(from_timezone))
@@ -319,6 +484,14 @@ def main():
             
         elif choice == "0":
             print("Exiting program")
+            if worker.running:
+                print("Stopping scheduler, waiting for the current check to finish...")
+                worker.stop()
+            ice_maker.dispatcher.shutdown()
+            if ice_maker.quota is not None:
+                ice_maker.quota.save()
+            if daemon:
+                daemon.close()
             break
             
         else:
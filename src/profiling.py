@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+调度器性能分析
+PhaseTimings 记录各阶段（调度循环的每一步、每次API调用）的耗时和CPU时间，
+保存在内存中的滚动窗口里；SamplingProfiler 可以在运行中的守护进程里随时开始/停止采样，
+不需要重启
+"""
+
+import sys
+import time
+import threading
+import functools
+from collections import Counter, deque
+from contextlib import contextmanager
+
+# 耗时直方图的桶上限（秒），最后一个桶收集更慢的样本
+BUCKET_BOUNDS = (0.001, 0.01, 0.1, 1.0, 10.0)
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+class PhaseTimings:
+    """Rolling wall/CPU time samples per named phase
+
+    CPU time is the calling thread's (time.thread_time), so phases running
+    on the account worker threads are measured independently.
+    """
+
+    def __init__(self, window=1000):
+        """
+        Args:
+            window: Samples kept per phase, older ones are dropped
+        """
+        self.window = window
+        self._samples = {}
+        self._totals = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as one sample of phase name"""
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+    def record(self, name, wall, cpu):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self.window)
+            samples.append((wall, cpu))
+            self._totals[name] += 1
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._totals.clear()
+
+    def summary(self):
+        """Statistics of the samples in the window
+
+        Returns:
+            dict: {phase: {"count": total samples since start/reset, "window": samples kept,
+                "wall": {"mean", "p50", "p95", "max", "total"}, "cpu": {...},
+                "buckets": wall time counts per BUCKET_BOUNDS bucket (last is slower)}}
+        """
+        with self._lock:
+            snapshot = {name: list(samples) for name, samples in self._samples.items()}
+            totals = dict(self._totals)
+        result = {}
+        for name, samples in snapshot.items():
+            stats = {"count": totals[name], "window": len(samples)}
+            for label, column in (("wall", 0), ("cpu", 1)):
+                values = sorted(sample[column] for sample in samples)
+                stats[label] = {
+                    "mean": sum(values) / len(values),
+                    "p50": _percentile(values, 0.5),
+                    "p95": _percentile(values, 0.95),
+                    "max": values[-1],
+                    "total": sum(values),
+                }
+            buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+            for wall, _ in samples:
+                buckets[next((i for i, bound in enumerate(BUCKET_BOUNDS) if wall <= bound), len(BUCKET_BOUNDS))] += 1
+            stats["buckets"] = buckets
+            result[name] = stats
+        return result
+
+    def format_summary(self):
+        """Summary as printable lines, slowest phases (by total wall time) first"""
+        summary = self.summary()
+        if not summary:
+            return ["No timings recorded yet"]
+        lines = [f"{'phase':<28} {'count':>7} {'wall p50':>9} {'wall p95':>9} {'wall max':>9} "
+                 f"{'cpu p50':>9} {'cpu p95':>9}"]
+        for name, stats in sorted(summary.items(), key=lambda item: -item[1]["wall"]["total"]):
+            wall, cpu = stats["wall"], stats["cpu"]
+            lines.append(f"{name:<28} {stats['count']:>7} {wall['p50'] * 1000:>7.1f}ms {wall['p95'] * 1000:>7.1f}ms "
+                         f"{wall['max'] * 1000:>7.1f}ms {cpu['p50'] * 1000:>7.1f}ms {cpu['p95'] * 1000:>7.1f}ms")
+        return lines
+
+
+# 进程内共享的计时表，Request 和调度循环都记录到这里
+timings = PhaseTimings()
+
+
+def timed(name):
+    """Decorator recording every call of the function as phase name"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timings.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+    """Statistical profiler sampling the stacks of all threads
+
+    Unlike cProfile, which only sees the thread that enabled it, sampling
+    covers the scheduler loop, the account workers and the control socket
+    alike, and can be started and stopped from a signal handler or socket
+    request while the daemon keeps running.
+    """
+
+    def __init__(self, interval=0.005):
+        """
+        Args:
+            interval: Seconds between samples
+        """
+        self.interval = interval
+        self._stacks = Counter()
+        self._samples = 0
+        self._started = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        # 控制锁：信号处理线程和控制套接字可能同时启停；调用方在 stop()/write()/top()
+        # 期间持有它，保证写出的是本次停止的样本
+        self.lock = threading.RLock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return False
+            self._stacks.clear()
+            self._samples = 0
+            self._started = time.monotonic()
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        """Stop sampling
+
+        Returns:
+            dict: {"samples", "seconds"}, or None if the profiler was not running
+        """
+        with self.lock:
+            if not self.running:
+                return None
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+            return {"samples": self._samples, "seconds": time.monotonic() - self._started}
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self._stacks[";".join(reversed(stack))] += 1
+            self._samples += 1
+
+    def top(self, limit=20):
+        """Functions by inclusive sample count
+
+        Returns:
+            list: (function, samples) pairs, most sampled first
+        """
+        inclusive = Counter()
+        for stack, count in self._stacks.items():
+            # 递归函数每个栈只计一次
+            for function in {entry.rsplit(":", 1)[0] for entry in stack.split(";")}:
+                inclusive[function + ")"] += count
+        return inclusive.most_common(limit)
+
+    def write(self, path):
+        """Write the samples in collapsed-stack format (one "stack count" per line, flamegraph.pl input)"""
+        with open(path, "w") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
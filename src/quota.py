@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+API配额预算
+按API密钥统计每日请求次数，根据已编排的定时任务预测当天剩余用量，
+优先为定时命令预留配额，在达到上限前限制设备列表刷新、状态查询等非必要请求
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import logging
+import threading
+import pytz
+from clock import SystemClock
+
+logger = logging.getLogger(__name__)
+
+# 请求类别
+KIND_SCHEDULED = "scheduled"
+KIND_DISCRETIONARY = "discretionary"
+
+# Govee 每个账号每天的请求上限
+DEFAULT_DAILY_LIMIT = 10000
+
+
+def key_id(api_key_value):
+    """Short non-reversible identifier of an API key, safe to persist and log"""
+    return hashlib.sha256(api_key_value.encode("utf-8")).hexdigest()[:12]
+
+
+class QuotaAccountant:
+    """Per-key daily request counter with a reserve for scheduled commands
+
+    Days are UTC days, matching when the Govee counter resets. Scheduled
+    calls may use the whole limit; discretionary calls are refused once
+    used + reserved would reach limit - headroom.
+    """
+
+    def __init__(self, daily_limit=DEFAULT_DAILY_LIMIT, state_file=None, clock=None,
+                 headroom=50, save_every=20):
+        """
+        Args:
+            daily_limit: Requests allowed per key per UTC day
+            state_file: JSON file the counters are persisted to, None keeps them in memory
+            clock: Clock object, default is the system clock
+            headroom: Requests kept free for retries and manual recovery
+            save_every: Persist the counters after this many calls
+        """
+        self.daily_limit = daily_limit
+        self.state_file = state_file
+        self.clock = clock or SystemClock()
+        self.headroom = headroom
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        # 串行化写文件，多个线程同时保存时不会互相替换临时文件
+        self._save_lock = threading.Lock()
+        # (密钥标识, UTC日期) -> 已用次数
+        self._used = {}
+        # 密钥标识 -> 当天剩余定时命令的预留次数
+        self._reserved = {}
+        self._unsaved = 0
+        self._load()
+
+    def _today(self):
+        return self.clock.now(pytz.UTC).date().isoformat()
+
+    def _load(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read quota state {self.state_file}: {e}")
+            return
+        today = self._today()
+        self._used = {(key, today): count for key, count in data.get(today, {}).items()}
+
+    def save(self):
+        """Persist today's counters
+
+        Safe to call from several threads; a failed write is logged and
+        retried with the next save.
+        """
+        if not self.state_file:
+            return
+        with self._save_lock:
+            today = self._today()
+            with self._lock:
+                data = {today: {key: count for (key, day), count in self._used.items() if day == today}}
+                unsaved, self._unsaved = self._unsaved, 0
+            directory = os.path.dirname(os.path.abspath(self.state_file))
+            fd, tmp_path = tempfile.mkstemp(prefix=".api_quota.", suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.state_file)
+            except OSError as e:
+                logger.warning(f"Could not save quota state {self.state_file}: {e}")
+                with self._lock:
+                    self._unsaved += unsaved
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+
+    def used(self, api_key_value):
+        """Requests made with the key today"""
+        with self._lock:
+            return self._used.get((key_id(api_key_value), self._today()), 0)
+
+    def reserve(self, api_key_value, calls):
+        """Set the number of calls still needed today by scheduled commands"""
+        with self._lock:
+            self._reserved[key_id(api_key_value)] = max(0, int(calls))
+
+    def reserved(self, api_key_value):
+        with self._lock:
+            return self._reserved.get(key_id(api_key_value), 0)
+
+    def allows(self, api_key_value, kind=KIND_DISCRETIONARY):
+        """Whether a call of the given kind fits in today's budget"""
+        used = self.used(api_key_value)
+        if kind == KIND_SCHEDULED:
+            return used < self.daily_limit
+        return used + self.reserved(api_key_value) < self.daily_limit - self.headroom
+
+    def acquire(self, api_key_value, kind=KIND_DISCRETIONARY):
+        """Count a call if the budget allows it
+
+        Returns:
+            bool: True if the call may be sent
+        """
+        if not self.allows(api_key_value, kind):
+            logger.warning(f"Quota: {kind} call refused for key {key_id(api_key_value)} "
+                           f"(used {self.used(api_key_value)}/{self.daily_limit}, "
+                           f"reserved {self.reserved(api_key_value)})")
+            return False
+        with self._lock:
+            counter = (key_id(api_key_value), self._today())
+            self._used[counter] = self._used.get(counter, 0) + 1
+            self._unsaved += 1
+            save_now = self._unsaved >= self.save_every
+        if kind == KIND_SCHEDULED:
+            with self._lock:
+                reserved_key = key_id(api_key_value)
+                self._reserved[reserved_key] = max(0, self._reserved.get(reserved_key, 0) - 1)
+        if save_now:
+            self.save()
+        return True
+
+    def summary(self, api_key_value):
+        """Usage snapshot for status displays"""
+        return {
+            "key": key_id(api_key_value),
+            "day": self._today(),
+            "used": self.used(api_key_value),
+            "reserved": self.reserved(api_key_value),
+            "limit": self.daily_limit,
+        }
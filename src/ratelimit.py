@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求速率限制
+令牌桶限速器，每个API密钥一个，保证单个账号的请求速率不超过设定值
+"""
+
+import threading
+import time
+import pytz
+
+
+class TokenBucket:
+    """Blocking token bucket
+
+    Tokens refill continuously at rate_per_minute / 60 per second up to
+    capacity; acquire() waits until a token is available.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None, clock=None):
+        """
+        Args:
+            rate_per_minute: Sustained requests per minute
+            capacity: Burst size, default is rate_per_minute / 6 (10 seconds worth), at least 1
+            clock: Clock object (e.g. VirtualClock), default uses time.monotonic/time.sleep
+        """
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_minute / 6.0)
+        if clock is None:
+            self._now, self._sleep = time.monotonic, time.sleep
+        else:
+            self._now, self._sleep = (lambda: clock.now(pytz.UTC).timestamp()), clock.sleep
+        self._tokens = self.capacity
+        self._updated = self._now()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._now()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Take a token, waiting as long as necessary
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+            waited += wait
@@ -5,16 +5,57 @@ import requests
 import uuid
 import time
 import os
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta
 import pytz
 import json
+import socket
 import logging
+from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from clock import SystemClock
+from journal import request_id_for
+from capabilities import CapabilityIndex
+from quota import KIND_SCHEDULED, KIND_DISCRETIONARY
+from schedule import normalize_schedule, MINUTES_PER_DAY
+from task_store import TaskStore, Task, Action, DAILY_FLAG
+from profiling import timings, timed
+from device_queue import DeviceDispatcher
+
+# 定时命令失败时可以用同一个 requestId 重试的状态码
+RETRYABLE_CODES = (429, 500, 502, 503, 504)
+
+# 上海时间（东八区，无夏令时）相对UTC的分钟数，定时任务按上海时间的时分比较
+SHANGHAI_OFFSET_MINUTES = 8 * 60
+
+# 每日任务在到点后多少分钟内执行；单次任务在到点后多少分钟内执行，超过则视为过期
+DAILY_DUE_MINUTES = 5
+ONE_TIME_DUE_MINUTES = 10
 
 # 获取logger
 logger = logging.getLogger(__name__)
 
 class Request:
-    def __init__(self, api_key, api_key_value):
+    def __init__(self, api_key, api_key_value, clock=None, transport=None, dispatch_planner=None,
+                 journal=None, command_retries=2, state_table=None, quota=None, rate_limiter=None,
+                 concurrency=None, verifier=None, history=None):
+        """
+        Args:
+            api_key: API密钥名称
+            api_key_value: API密钥值
+            clock: 时钟对象，默认为系统时钟（模拟模式下传入VirtualClock）
+            transport: HTTP传输对象，需提供get/post方法，默认为该实例独享的requests.Session连接池
+            dispatch_planner: 命令下发计划器(DispatchPlanner)，为None时到期命令立即依次发送
+            journal: 命令日志(CommandJournal)，用于定时命令的幂等键持久化，为None时不持久化
+            command_retries: 定时命令失败后的重试次数，重试复用同一个requestId
+            state_table: 设备状态表(DeviceStateTable)，由事件订阅和成功的命令更新，为None时不记录
+            quota: API配额预算(QuotaAccountant)，为None时不限制
+            rate_limiter: 该密钥的请求限速器(TokenBucket)，为None时不限速
+            concurrency: 控制请求的自适应并发限制(AdaptiveConcurrencyLimiter)，设置后命令进入按设备排序的队列，
+                不同设备并行发送；为None时定时命令依次发送
+            verifier: 命令执行确认(CommandVerifier)，命令被云端接受后轮询设备状态确认，为None时不确认
+            history: 命令执行历史(ExecutionHistory)，记录每条控制命令的时间、耗时和结果，为None时不记录
+        """
         self.api_key = api_key
         self.api_key_value = api_key_value
         self.base_url = "https://openapi.api.govee.com"
@@ -22,24 +63,56 @@ class Request:
             "Content-Type": "application/json",
             self.api_key: self.api_key_value
         }
+        self.clock = clock or SystemClock()
+        self.http = transport or requests.Session()
+        self.dispatch_planner = dispatch_planner
+        self.journal = journal
+        self.command_retries = command_retries
+        self.state_table = state_table
+        self.quota = quota
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
+        self.verifier = verifier
+        self.history = history
+        # 按设备排序的命令队列，同一设备的命令依次执行，不同设备并行
+        self.dispatcher = DeviceDispatcher(max_workers=concurrency.max_limit) if concurrency is not None else None
+        # 设备列表获取失败后的退避：下次允许尝试的时间和当前退避秒数
+        self._next_inventory_attempt = None
+        self._inventory_backoff = 0
+        # API密钥最近一次确认有效的UTC日期，预热时当天只校验一次
+        self._credentials_valid_on = None
         # 设备信息缓存
         self.devices = None
-        # 定时任务列表 [(设备ID, 操作类型, 目标时间)]
-        self.scheduled_tasks = []
+        # 设备能力索引，获取设备列表后建立，用于在本地校验命令
+        self.capabilities = CapabilityIndex()
+        # 定时任务 [(设备型号, 设备ID, 操作类型, 目标时间)]，调度线程、菜单和控制套接字会并发读写
+        self.tasks = TaskStore()
+        # 最后一次检查定时任务的时间(UTC)
+        self.last_check_time = None
         # 已加载的日期
         self.loaded_date = None
         # 上次使用的配置文件路径
         self.last_config_file = None
+        # 配置文件路径 -> (原始时间列表, 规范化结果)，配置不变时不重复规范化和告警
+        self._normalized_schedules = {}
         # 标记每日任务是否已执行
         self._daily_tasks_executed = False
         # 最后一次检查的日期
-        self.last_check_date = date.today()
+        self.last_check_date = self.clock.today()
 
+    @property
+    def scheduled_tasks(self):
+        """Snapshot of the scheduled tasks"""
+        return self.tasks.snapshot()
+    
     def get_devices(self):
         """获取所有设备信息"""
         url = f"{self.base_url}/router/api/v1/user/devices"
+        if not self._acquire_quota(KIND_DISCRETIONARY):
+            return {"code": 429, "message": "每日API配额已预留给定时任务", "data": [], "throttled_locally": True}
         try:
-            response = requests.get(url, headers=self.headers)
+            with timings.phase("api.get_devices"):
+                response = self.http.get(url, headers=self.headers)
             
             # 检查响应状态码
             if response.status_code != 200:
@@ -53,6 +126,8 @@ class Request:
                 
                 if result.get("code") == 200:
                     self.devices = result.get("data", [])
+                    self.capabilities = CapabilityIndex.from_devices(self.devices)
+                    self._credentials_valid_on = self.clock.now(pytz.UTC).date()
                 
                 return result
             except json.JSONDecodeError as e:
@@ -64,57 +139,49 @@ class Request:
             print(f"请求异常: {e}")
             return {"code": 500, "message": f"请求异常: {str(e)}", "data": []}
     
-    def control_device(self, sku, device_id, power_status):
+    def control_device(self, sku, device_id, power_status, request_id=None, kind=KIND_DISCRETIONARY):
         """控制设备开关
         
         Args:
             sku: 设备型号
             device_id: 设备ID
             power_status: 1表示开机，0表示关机
+            request_id: 请求ID，重试时传入同一个值，默认生成新的UUID
+            kind: 配额类别，定时命令为KIND_SCHEDULED，可使用为其预留的配额
         """
-        url = f"{self.base_url}/router/api/v1/device/control"
-        
-        payload = {
-            "requestId": str(uuid.uuid4()),
-            "payload": {
-                "sku": sku,
-                "device": device_id,
-                "capability": {
-                    "type": "devices.capabilities.on_off",
-                    "instance": "powerSwitch",
-                    "value": power_status
-                }
-            }
-        }
-        
-        try:
-            response = requests.post(url, headers=self.headers, json=payload)
-            
-            # 检查响应状态码
-            if response.status_code != 200:
-                print(f"API请求失败: 状态码 {response.status_code}")
-                print(f"响应内容: {response.text}")
-                return {"code": response.status_code, "message": "API请求失败"}
-            
-            # 尝试解析JSON响应
-            try:
-                return response.json()
-            except json.JSONDecodeError as e:
-                print(f"JSON解析错误: {e}")
-                print(f"响应内容: {response.text}")
-                return {"code": 500, "message": "JSON解析错误"}
-                
-        except requests.RequestException as e:
-            print(f"请求异常: {e}")
-            return {"code": 500, "message": f"请求异常: {str(e)}"}
+        return self._send_control(sku, device_id, "devices.capabilities.on_off", "powerSwitch",
+                                  power_status, request_id=request_id, kind=kind)
     
-    def open_device(self, sku, device_id):
+    def open_device(self, sku, device_id, request_id=None):
         """开启设备"""
-        return self.control_device(sku, device_id, 1)
+        return self.control_device(sku, device_id, 1, request_id=request_id)
     
-    def close_device(self, sku, device_id):
+    def close_device(self, sku, device_id, request_id=None):
         """关闭设备"""
-        return self.control_device(sku, device_id, 0)
+        return self.control_device(sku, device_id, 0, request_id=request_id)
+    
+    def submit_ordered(self, device_id, capability, function, *args, **kwargs):
+        """Queue a command behind the device's earlier commands
+        
+        Without a dispatcher the command runs right away in the calling thread.
+        
+        Args:
+            device_id: Device the command is for
+            capability: Capability instance it sets (powerSwitch, workMode); a queued
+                command for the same capability that has not started is superseded
+        
+        Returns:
+            Future: Resolves to the command's result
+        """
+        if self.dispatcher is not None:
+            return self.dispatcher.submit(device_id, capability, function, *args, **kwargs)
+        future = Future()
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(function(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
     
     def set_work_mode(self, sku, device_id, mode):
         """设置工作模式
@@ -124,26 +191,103 @@ class Request:
             device_id: 设备ID
             mode: 工作模式 1-LargeIce, 2-MediumIce, 3-SmallIce
         """
+        value = {
+            "workMode": mode,
+            "modeValue": 0
+        }
+        return self._send_control(sku, device_id, "devices.capabilities.work_mode", "workMode", value)
+    
+    def get_device_state(self, sku, device_id):
+        """查询设备当前状态（/device/state），结果写入设备状态表
+        
+        Returns:
+            dict: API result, payload.capabilities lists each instance's state.value
+        """
+        if not self._acquire_quota(KIND_DISCRETIONARY):
+            return {"code": 429, "message": "每日API配额已预留给定时任务", "throttled_locally": True}
+        url = f"{self.base_url}/router/api/v1/device/state"
+        payload = {"requestId": str(uuid.uuid4()), "payload": {"sku": sku, "device": device_id}}
+        try:
+            with timings.phase("api.device_state"):
+                response = self.http.post(url, headers=self.headers, json=payload)
+            if response.status_code != 200:
+                return {"code": response.status_code, "message": "API请求失败"}
+            result = response.json()
+        except (requests.RequestException, json.JSONDecodeError) as e:
+            logger.warning(f"Device state query failed for {device_id}: {e}")
+            return {"code": 500, "message": f"请求异常: {str(e)}"}
+        if self.state_table is not None and result.get("code") == 200:
+            now = self.clock.now(pytz.UTC)
+            for capability in (result.get("payload") or {}).get("capabilities", []):
+                state = capability.get("state") or {}
+                if "value" in state:
+                    self.state_table.update(device_id, capability.get("instance"), state["value"],
+                                            source="poll", at=now)
+        return result
+    
+    def _send_control(self, sku, device_id, capability_type, instance, value, request_id=None,
+                      kind=KIND_DISCRETIONARY, verify=True):
+        """Validate a capability command locally and post it to /device/control
+        
+        Args:
+            sku: Device model
+            device_id: Device ID
+            capability_type: Capability type, e.g. devices.capabilities.on_off
+            instance: Capability instance, e.g. powerSwitch
+            value: Capability value
+            request_id: Request ID, a new UUID when None
+            kind: Quota kind of the call
+            verify: Register the command with the verifier once the cloud accepts it
+        
+        Every outcome, including local rejections, is added to the execution
+        history with the time the command took (rate limiter waits included).
+        
+        Returns:
+            dict: API result; code 400 when the command was rejected locally,
+                429 with throttled_locally when the daily budget does not allow it
+        """
+        started = time.monotonic()
+        result = self._post_control(sku, device_id, capability_type, instance, value,
+                                    request_id=request_id, kind=kind, verify=verify)
+        if self.history is not None:
+            self.history.record(device_id, instance, value, time.monotonic() - started, result.get("code"),
+                                scheduled=kind == KIND_SCHEDULED)
+        return result
+    
+    def _post_control(self, sku, device_id, capability_type, instance, value, request_id=None,
+                      kind=KIND_DISCRETIONARY, verify=True):
+        """Body of _send_control, without the history record"""
+        error = self.capabilities.validate(sku, device_id, instance, value)
+        if error:
+            logger.warning(f"Command rejected locally: {error}")
+            print(f"命令未发送: {error}")
+            return {"code": 400, "message": error}
+        
+        if not self._acquire_quota(kind):
+            print("命令未发送: 每日API配额不足")
+            return {"code": 429, "message": "每日API配额不足", "throttled_locally": True}
+        
         url = f"{self.base_url}/router/api/v1/device/control"
         
         payload = {
-            "requestId": str(uuid.uuid4()),
+            "requestId": request_id or str(uuid.uuid4()),
             "payload": {
                 "sku": sku,
                 "device": device_id,
                 "capability": {
-                    "type": "devices.capabilities.work_mode",
-                    "instance": "workMode",
-                    "value": {
-                        "workMode": mode,
-                        "modeValue": 0
-                    }
+                    "type": capability_type,
+                    "instance": instance,
+                    "value": value
                 }
             }
         }
         
+        token = self.concurrency.acquire() if self.concurrency is not None else None
+        overloaded = True
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            with timings.phase("api.control"):
+                response = self.http.post(url, headers=self.headers, json=payload)
+            overloaded = response.status_code in (429, 503)
             
             # 检查响应状态码
             if response.status_code != 200:
@@ -153,15 +297,70 @@ class Request:
             
             # 尝试解析JSON响应
             try:
-                return response.json()
+                result = response.json()
             except json.JSONDecodeError as e:
                 print(f"JSON解析错误: {e}")
                 print(f"响应内容: {response.text}")
                 return {"code": 500, "message": "JSON解析错误"}
+            
+            overloaded = result.get("code") == 429
+            
+            # 云端已接受命令，记录为设备的最新已知状态
+            if self.state_table is not None and result.get("code") == 200:
+                self.state_table.update(device_id, instance, value, source="command",
+                                        at=self.clock.now(pytz.UTC))
+            # 云端接受不代表设备已执行，登记后由后台轮询确认，未生效时按设备顺序重新发送
+            if self.verifier is not None and verify and result.get("code") == 200:
+                self.verifier.expect(
+                    sku, device_id, instance, value, poll=self.get_device_state,
+                    resend=lambda: self.submit_ordered(device_id, instance, self._send_control, sku, device_id,
+                                                       capability_type, instance, value, kind=kind, verify=False))
+            return result
                 
         except requests.RequestException as e:
             print(f"请求异常: {e}")
             return {"code": 500, "message": f"请求异常: {str(e)}"}
+        finally:
+            # 429/503、超时和连接错误都说明云端过载，降低并发
+            if token is not None:
+                self.concurrency.release(token, overloaded=overloaded)
+    
+    def _acquire_quota(self, kind):
+        """Count one API call against the daily budget and wait for the rate limiter
+        
+        Returns:
+            bool: False if the budget does not allow the call
+        """
+        if self.quota is not None and not self.quota.acquire(self.api_key_value, kind):
+            return False
+        if self.rate_limiter is not None:
+            with timings.phase("rate_limit.wait"):
+                self.rate_limiter.acquire()
+        return True
+    
+    def forecast_scheduled_calls(self):
+        """Number of scheduled commands still due before the end of the UTC day
+        
+        Daily tasks fire on their Shanghai minute of day; one whose minute has
+        passed stays in the list until tomorrow and is only counted when that
+        next firing falls before the end of the UTC day.
+        """
+        now = self.clock.now(pytz.UTC)
+        end_of_day = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        end_epoch = int(end_of_day.timestamp())
+        now_epoch = int(now.timestamp())
+        now_total_minutes = (now_epoch // 60 + SHANGHAI_OFFSET_MINUTES) % MINUTES_PER_DAY
+        minutes_left = (end_epoch - now_epoch) / 60
+        count = 0
+        for task in self.tasks.snapshot():
+            if task.action & DAILY_FLAG:
+                target_total_minutes = (task.epoch // 60 + SHANGHAI_OFFSET_MINUTES) % MINUTES_PER_DAY
+                # 距上次到期的分钟数：在执行窗口内说明现在就会执行，否则计算到下次执行的分钟数
+                since_due = (now_total_minutes - target_total_minutes) % MINUTES_PER_DAY
+                count += since_due <= DAILY_DUE_MINUTES or MINUTES_PER_DAY - since_due < minutes_left
+            else:
+                count += task.epoch < end_epoch
+        return count
     
     def schedule_task(self, sku, device_id, action_type, target_time_utc):
         """设置定时任务
@@ -171,10 +370,46 @@ class Request:
             device_id: 设备ID
             action_type: "open" 或 "close"
             target_time_utc: UTC时间格式的目标时间
+        
+        Raises:
+            ValueError: 未知的操作类型
         """
-        self.scheduled_tasks.append((sku, device_id, action_type, target_time_utc))
+        self.tasks.add(Task.create(sku, device_id, action_type, target_time_utc))
         print(f"已设置任务: 设备{device_id} 将在 {target_time_utc} (UTC时间) {action_type}")
     
+    def list_tasks(self):
+        """Return a snapshot of the scheduled tasks
+        
+        Returns:
+            list: Dicts with key, sku, device, action, target_time (ISO UTC) and state
+        """
+        listed = []
+        for task in self.tasks.snapshot():
+            key = task.key
+            listed.append({
+                "key": key,
+                "sku": task.sku,
+                "device": task.device_id,
+                "action": task.action_type,
+                "target_time": task.target_time.isoformat(),
+                "state": self.journal.state(key) if self.journal is not None else None,
+            })
+        return listed
+    
+    def cancel_task(self, key):
+        """Remove the scheduled task(s) with the given idempotency key
+        
+        Returns:
+            int: Number of removed tasks
+        """
+        # 幂等键格式为 sku|device|action|time，只需检查该设备的任务
+        parts = key.split("|")
+        device_id = parts[1] if len(parts) == 4 else None
+        removed = self.tasks.remove_where(lambda task: task.key == key, device_id=device_id)
+        if removed:
+            logger.info(f"Cancelled Task: {key}")
+        return removed
+    
     def schedule_with_timezone(self, sku, device_id, action_type, target_time, from_timezone="America/Vancouver", to_timezone="Asia/Shanghai"):
         """设置定时任务，处理时区转换
         
@@ -202,6 +437,7 @@ class Request:
         # 设置任务
         self.schedule_task(sku, device_id, action_type, utc_dt)
     
+    @timed("config.read")
     def read_daily_controller_times(self, file_path="dailycontrollertime.txt"):
         """从配置文件读取每日定时任务
         
@@ -239,6 +475,7 @@ class Request:
             print(f"读取配置文件失败: {e}")
             return times
     
+    @timed("setup_daily_tasks")
     def setup_daily_tasks(self, sku, device_id, from_timezone="America/Vancouver", config_file=None):
         """Set up daily scheduled tasks
         
@@ -259,7 +496,7 @@ class Request:
                 logger.info("Using US/Mountain timezone")
         
         # Get today's date
-        today = date.today()
+        today = self.clock.today()
         
         # Check if it's a new day
         if self.last_check_date != today:
@@ -277,16 +514,24 @@ class Request:
         if config_file is None:
             config_file = self.last_config_file or "dailycontrollertime.txt"
         
-        # Read config file
-        controller_times = self.read_daily_controller_times(config_file)
+        # Read config file and drop duplicate, contradictory and no-op transitions
+        raw_times = self.read_daily_controller_times(config_file)
+        raw_key = (tuple(raw_times["open"]), tuple(raw_times["close"]))
+        cached = self._normalized_schedules.get(config_file)
+        if cached is not None and cached[0] == raw_key:
+            controller_times = cached[1]
+        else:
+            controller_times = normalize_schedule(raw_times["open"], raw_times["close"])
+            self._normalized_schedules[config_file] = (raw_key, controller_times)
+            for issue in controller_times["issues"]:
+                logger.warning(f"Schedule {config_file}: {issue}")
         
         # Get timezone object
         source_tz = pytz.timezone(from_timezone)
         
-        # Clear previous tasks
-        # Keep only non-daily tasks
-        self.scheduled_tasks = [task for task in self.scheduled_tasks 
-                                if not task[2].startswith("daily_")]
+        # Build the device's daily tasks, then swap them in at once so a
+        # concurrent check never sees a half-built list
+        daily_tasks = []
         
         logger.info(f"Setting up daily tasks using timezone: {from_timezone}")
         
@@ -301,7 +546,7 @@ class Request:
                 hour, minute = map(int, time_str.split(":"))
                 
                 # Build today's datetime
-                now = datetime.now()
+                now = self.clock.now()
                 task_time = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
                 
                 # Add timezone info - This is Vancouver time (UTC-7)
@@ -314,7 +559,7 @@ class Request:
                 china_dt = utc_dt.astimezone(pytz.timezone("Asia/Shanghai"))
                 
                 # Add task
-                self.scheduled_tasks.append((sku, device_id, "daily_open", utc_dt))
+                daily_tasks.append(Task(sku, device_id, Action.DAILY_OPEN, int(utc_dt.timestamp())))
                 
                 logger.info(f"Daily Power On Task Set:")
                 logger.info(f" - Time: {hour:02d}:{minute:02d}")
@@ -336,7 +581,7 @@ class Request:
                 hour, minute = map(int, time_str.split(":"))
                 
                 # Build today's datetime
-                now = datetime.now()
+                now = self.clock.now()
                 task_time = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
                 
                 # Add timezone info - This is Vancouver time (UTC-7)
@@ -349,7 +594,7 @@ class Request:
                 china_dt = utc_dt.astimezone(pytz.timezone("Asia/Shanghai"))
                 
                 # Add task
-                self.scheduled_tasks.append((sku, device_id, "daily_close", utc_dt))
+                daily_tasks.append(Task(sku, device_id, Action.DAILY_CLOSE, int(utc_dt.timestamp())))
                 
                 logger.info(f"Daily Power Off Task Set:")
                 logger.info(f" - Time: {hour:02d}:{minute:02d}")
@@ -360,13 +605,17 @@ class Request:
             except ValueError as e:
                 logger.error(f"Time format error: {time_str}, error: {e}")
         
+        # Replace previous daily tasks of this device, keep one-time tasks and other devices' tasks
+        self.tasks.replace_daily(device_id, daily_tasks)
+        
         # Update loaded date
         self.loaded_date = today
     
+    @timed("check_scheduled_tasks")
     def check_scheduled_tasks(self):
         """Check and execute scheduled tasks, runs every 5 minutes"""
         # Get current UTC time
-        current_time_utc = datetime.now(pytz.UTC)
+        current_time_utc = self.clock.now(pytz.UTC)
         # Get current times in different timezones
         current_time_shanghai = current_time_utc.astimezone(pytz.timezone("Asia/Shanghai"))
         current_time_vancouver = current_time_utc.astimezone(pytz.timezone("America/Vancouver"))
@@ -376,111 +625,367 @@ class Request:
         logger.info(f" - Shanghai Time (UTC+8): {current_time_shanghai.strftime('%H:%M:%S')}")
         logger.info(f" - Vancouver Time (UTC-7): {current_time_vancouver.strftime('%H:%M:%S')}")
         
+        self.last_check_time = current_time_utc
+        
+        # Reserve today's budget for the scheduled commands still to come
+        if self.quota is not None:
+            self.quota.reserve(self.api_key_value, self.forecast_scheduled_calls() * (1 + self.command_retries))
+        
         completed_tasks = []
+        due_tasks = []
         
-        for index, (sku, device_id, action_type, target_time) in enumerate(self.scheduled_tasks):
-            # Convert target time to different timezones (for logging)
-            target_shanghai = target_time.astimezone(pytz.timezone("Asia/Shanghai"))
-            target_vancouver = target_time.astimezone(pytz.timezone("America/Vancouver"))
-            
-            # Extract only hours and minutes for comparison
-            current_hour, current_minute = current_time_shanghai.hour, current_time_shanghai.minute
-            target_hour, target_minute = target_shanghai.hour, target_shanghai.minute
-            
-            # Convert to total minutes for easy comparison
-            current_total_minutes = current_hour * 60 + current_minute
-            target_total_minutes = target_hour * 60 + target_minute
-            
-            # Calculate time difference (minutes) - only consider time within 24 hours
-            if target_total_minutes <= current_total_minutes:
-                # Target time has already passed today
+        # Work on a snapshot so the control socket can add or cancel tasks meanwhile
+        tasks = self.tasks.snapshot()
+        
+        # Compare integer epochs; Shanghai has no DST so its minute of day is a fixed offset from UTC
+        now_epoch = current_time_utc.timestamp()
+        current_total_minutes = (int(now_epoch) // 60 + SHANGHAI_OFFSET_MINUTES) % MINUTES_PER_DAY
+        verbose = logger.isEnabledFor(logging.DEBUG)
+        
+        for index, task in enumerate(tasks):
+            if task.action & DAILY_FLAG:
+                # Daily tasks compare time of day only, within 24 hours
+                target_total_minutes = (task.epoch // 60 + SHANGHAI_OFFSET_MINUTES) % MINUTES_PER_DAY
                 time_diff_minutes = current_total_minutes - target_total_minutes
-                time_status = "passed"
-            else:
-                # Target time hasn't arrived yet today
-                time_diff_minutes = target_total_minutes - current_total_minutes
-                time_status = "upcoming"
-            
-            # Log task details
-            logger.info(f"Checking Task {index+1}: {action_type}")
-            logger.info(f" - Target Time (UTC): {target_time.strftime('%H:%M:%S')}")
-            logger.info(f" - Target Time (Shanghai): {target_shanghai.strftime('%H:%M:%S')}")
-            logger.info(f" - Target Time (Vancouver): {target_vancouver.strftime('%H:%M:%S')}")
-            logger.info(f" - Time Comparison: Target {target_hour:02d}:{target_minute:02d} vs Current {current_hour:02d}:{current_minute:02d}")
-            logger.info(f" - Time Difference: {time_diff_minutes} minutes ({time_status})")
-            
-            # Determine if task should be executed
-            should_execute = False
-            
-            # For daily tasks, execute if the time has just passed (within 5 minutes)
-            if action_type.startswith("daily_") and time_status == "passed" and time_diff_minutes <= 5:
-                should_execute = True
-                logger.info(f" - Decision: Execute (daily task, passed {time_diff_minutes} minutes ago)")
+                if verbose:
+                    self._log_task_check(index, task, current_total_minutes, target_total_minutes)
+                
+                # Execute if the time has just passed (within 5 minutes)
+                if 0 <= time_diff_minutes <= DAILY_DUE_MINUTES:
+                    logger.info(f"Checking Task {index+1}: {task.action_type}")
+                    logger.info(f" - Decision: Execute (daily task, passed {time_diff_minutes} minutes ago)")
+                    # One-time tasks go before daily ones
+                    due_tasks.append((1, task.sku, task.device_id, (index, task)))
+                continue
             
             # For one-time tasks, use traditional UTC time comparison
-            elif not action_type.startswith("daily_"):
-                # Calculate UTC time difference (minutes)
-                utc_time_diff = (current_time_utc - target_time).total_seconds() / 60
-                if 0 <= utc_time_diff <= 10:
-                    should_execute = True
-                    logger.info(f" - Decision: Execute (one-time task, UTC diff: {utc_time_diff:.2f} minutes)")
-                elif utc_time_diff > 10:
-                    # One-time task expired too long ago
-                    logger.warning(f" - Decision: One-time task expired {utc_time_diff:.2f} minutes ago, will be removed")
-                    completed_tasks.append(index)
-                    continue
-                else:
-                    logger.info(f" - Decision: Not yet time to execute, wait ~{-utc_time_diff:.2f} minutes")
-                    continue
-            
-            # Execute task
-            if should_execute:
-                if action_type == "open" or action_type == "daily_open":
-                    logger.info(f"Executing Power On: Device {device_id}")
-                    result = self.open_device(sku, device_id)
-                    logger.info(f"Power On Result: {result}")
-                elif action_type == "close" or action_type == "daily_close":
-                    logger.info(f"Executing Power Off: Device {device_id}")
-                    result = self.close_device(sku, device_id)
-                    logger.info(f"Power Off Result: {result}")
-                
-                # Mark task as completed
+            utc_time_diff = (now_epoch - task.epoch) / 60
+            if verbose:
+                self._log_task_check(index, task, current_total_minutes,
+                                     (task.epoch // 60 + SHANGHAI_OFFSET_MINUTES) % MINUTES_PER_DAY)
+            if 0 <= utc_time_diff <= ONE_TIME_DUE_MINUTES:
+                logger.info(f"Checking Task {index+1}: {task.action_type}")
+                logger.info(f" - Decision: Execute (one-time task, UTC diff: {utc_time_diff:.2f} minutes)")
+                due_tasks.append((0, task.sku, task.device_id, (index, task)))
+            elif utc_time_diff > ONE_TIME_DUE_MINUTES:
+                # One-time task expired too long ago
+                logger.warning(f"Checking Task {index+1}: {task.action_type}")
+                logger.warning(f" - Decision: One-time task expired {utc_time_diff:.2f} minutes ago, will be removed")
                 completed_tasks.append(index)
+            elif verbose:
+                logger.debug(f" - Decision: Not yet time to execute, wait ~{-utc_time_diff:.2f} minutes")
+        
+        # Execute due tasks, spread across the dispatch window
+        with timings.phase("check.dispatch"):
+            completed_tasks.extend(self._dispatch_due(due_tasks))
         
         # Remove completed or expired tasks
         for index in sorted(completed_tasks, reverse=True):
-            task_info = self.scheduled_tasks[index]
-            if task_info[2].startswith("daily_"):
-                logger.info(f"Completed Daily Task: {task_info[2]}, Scheduled Time: {task_info[3].strftime('%H:%M:%S')}")
+            task = tasks[index]
+            if task.action & DAILY_FLAG:
+                logger.info(f"Completed Daily Task: {task.action_type}, Scheduled Time: {task.target_time.strftime('%H:%M:%S')}")
             else:
-                logger.info(f"Removing Task: {task_info[2]}, Scheduled Time: {task_info[3].strftime('%H:%M:%S')}")
-            del self.scheduled_tasks[index]
+                logger.info(f"Removing Task: {task.action_type}, Scheduled Time: {task.target_time.strftime('%H:%M:%S')}")
+        self.tasks.remove([tasks[index] for index in completed_tasks])
             
         # If all daily tasks are completed for the day, set a flag to avoid repeating execution
         self._daily_tasks_executed = True
     
-    def start_scheduler(self, interval=300):
+    def count_due(self, at_utc):
+        """Number of tasks a check at the given time would dispatch"""
+        at_epoch = at_utc.timestamp()
+        at_total_minutes = (int(at_epoch) // 60 + SHANGHAI_OFFSET_MINUTES) % MINUTES_PER_DAY
+        count = 0
+        for task in self.tasks.snapshot():
+            if task.action & DAILY_FLAG:
+                target_total_minutes = (task.epoch // 60 + SHANGHAI_OFFSET_MINUTES) % MINUTES_PER_DAY
+                count += 0 <= at_total_minutes - target_total_minutes <= DAILY_DUE_MINUTES
+            else:
+                count += 0 <= (at_epoch - task.epoch) / 60 <= ONE_TIME_DUE_MINUTES
+        return count
+    
+    def prewarm_for_check(self, check_time_utc):
+        """Prepare connections for the commands the check at check_time_utc will send
+        
+        Returns:
+            dict: prewarm() result, or None when nothing is due
+        """
+        due = self.count_due(check_time_utc)
+        if due == 0:
+            return None
+        # 没有并发限制时命令依次发送，一个连接就够了
+        connections = min(due, self.concurrency.max_limit) if self.concurrency is not None else 1
+        result = self.prewarm(connections)
+        logger.info(f"Pre-warmed {result['connections']} connection(s) for {due} command(s) due at "
+                    f"{check_time_utc.strftime('%H:%M:%S')} UTC in {result['seconds']:.2f} seconds, "
+                    f"credentials {'valid' if result['credentials_ok'] else 'NOT validated'}")
+        return result
+    
+    def check_credentials(self):
+        """Validate the API key at most once per UTC day
+        
+        A successful device list request today already proves the key; otherwise
+        one device list request is made whose result is not applied, so the
+        inventory and capability index are left alone.
+        
+        Returns:
+            bool: Whether the key is valid, None when the daily budget refused the check
+        """
+        today = self.clock.now(pytz.UTC).date()
+        if self._credentials_valid_on == today:
+            return True
+        if not self._acquire_quota(KIND_DISCRETIONARY):
+            return None
+        try:
+            with timings.phase("api.get_devices"):
+                response = self.http.get(f"{self.base_url}/router/api/v1/user/devices",
+                                         headers=self.headers, timeout=10)
+            valid = response.status_code == 200 and response.json().get("code") == 200
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"Credential check failed: {e}")
+            return False
+        if valid:
+            self._credentials_valid_on = today
+        return valid
+    
+    def prewarm(self, connections=1):
+        """Resolve DNS, open and TLS-handshake connections and validate the API key
+        
+        The connection pool is enlarged to hold the requested number of
+        connections, which are opened in parallel so they are all idle in the
+        pool when the burst starts. The credentials are checked once per UTC
+        day (check_credentials); that request opens one of the connections.
+        
+        Args:
+            connections: Number of connections the coming burst will use
+        
+        Returns:
+            dict: {"connections": connections opened, "credentials_ok", "seconds"}
+        """
+        started = time.monotonic()
+        url = urlparse(self.base_url)
+        # 当天已校验过密钥时不发校验请求，所有连接都由 HEAD 请求建立
+        checking = self._credentials_valid_on != self.clock.now(pytz.UTC).date()
+        warm = max(0, connections - 1) if checking else connections
+        if hasattr(self.http, "get_adapter"):
+            try:
+                socket.getaddrinfo(url.hostname, url.port or 443, proto=socket.IPPROTO_TCP)
+            except OSError as e:
+                logger.warning(f"DNS lookup for {url.hostname} failed: {e}")
+            adapter = self.http.get_adapter(self.base_url)
+            if getattr(adapter, "_pool_maxsize", connections) < connections:
+                prefix = f"{url.scheme}://"
+                replaced = self.http.adapters.get(prefix)
+                self.http.mount(prefix, HTTPAdapter(pool_maxsize=connections))
+                if replaced is not None:
+                    # 关闭旧适配器的连接池，避免连接泄漏
+                    replaced.close()
+        else:
+            # 非 requests.Session 的传输对象（如模拟模式）没有DNS和连接池
+            warm = 0
+        
+        with ThreadPoolExecutor(max_workers=warm + 1, thread_name_prefix="prewarm") as executor:
+            check = executor.submit(self.check_credentials)
+            opened = sum(executor.map(lambda _: self._open_connection(), range(warm)))
+            credentials_ok = check.result()
+        if credentials_ok is False:
+            logger.warning("Credential check before dispatch failed")
+        return {"connections": opened + (1 if checking else 0), "credentials_ok": bool(credentials_ok),
+                "seconds": time.monotonic() - started}
+    
+    def _open_connection(self):
+        """Open one pooled connection with an unauthenticated HEAD request
+        
+        The request waits for the key's rate limiter like every other call.
+        """
+        if self.rate_limiter is not None:
+            with timings.phase("rate_limit.wait"):
+                self.rate_limiter.acquire()
+        try:
+            self.http.head(self.base_url, timeout=10)
+            return True
+        except requests.RequestException as e:
+            logger.warning(f"Pre-warm connection failed: {e}")
+            return False
+    
+    def _log_task_check(self, index, task, current_total_minutes, target_total_minutes):
+        """Debug details of one task check, in the timezones the schedule is written in"""
+        target_time = task.target_time
+        logger.debug(f"Checking Task {index+1}: {task.action_type}")
+        logger.debug(f" - Target Time (UTC): {target_time.strftime('%H:%M:%S')}")
+        logger.debug(f" - Target Time (Shanghai): {target_time.astimezone(pytz.timezone('Asia/Shanghai')).strftime('%H:%M:%S')}")
+        logger.debug(f" - Target Time (Vancouver): {target_time.astimezone(pytz.timezone('America/Vancouver')).strftime('%H:%M:%S')}")
+        logger.debug(f" - Time Comparison: Target {target_total_minutes // 60:02d}:{target_total_minutes % 60:02d} "
+                     f"vs Current {current_total_minutes // 60:02d}:{current_total_minutes % 60:02d}")
+    
+    def _execute_scheduled(self, task):
+        """Send one scheduled power command at most once
+        
+        The command's idempotency key is persisted before sending and reused,
+        together with its requestId, for every retry; a key the journal has
+        already completed is not sent again.
+        
+        Args:
+            task: Task to execute
+        
+        Returns:
+            dict: API result, or None when the command had already been executed
+        """
+        sku, device_id = task.sku, task.device_id
+        power_status = task.action.power_status
+        label = "Power On" if power_status else "Power Off"
+        
+        key = task.key
+        if self.journal is not None and self.journal.is_done(key):
+            logger.info(f"Skipping {label}: Device {device_id}, already executed ({key})")
+            return None
+        request_id = self.journal.begin(key) if self.journal is not None else request_id_for(key)
+        
+        logger.info(f"Executing {label}: Device {device_id}")
+        for attempt in range(self.command_retries + 1):
+            result = self.control_device(sku, device_id, power_status, request_id=request_id,
+                                         kind=KIND_SCHEDULED)
+            if result.get("code") == 200:
+                if self.journal is not None:
+                    self.journal.complete(key)
+                break
+            if (result.get("code") not in RETRYABLE_CODES or result.get("throttled_locally")
+                    or attempt == self.command_retries):
+                break
+            logger.warning(f"{label} failed for device {device_id} (code {result.get('code')}), "
+                           f"retrying with requestId {request_id}")
+            self.clock.sleep(2 ** attempt)
+        logger.info(f"{label} Result: {result}")
+        return result
+    
+    def _dispatch_due(self, due_tasks):
+        """Send due tasks at their planned times
+        
+        With a concurrency limiter every command, even a single one, goes to
+        the per-device ordered queues, so it cannot overtake or race a manual
+        command for the same device; different devices run in parallel and
+        the limiter decides how many calls are in flight. Otherwise they are
+        sent one after another.
+        
+        Returns:
+            list: Indexes of the dispatched tasks
+        """
+        planned = self._plan_dispatch(due_tasks)
+        if self.dispatcher is None:
+            dispatched = []
+            for send_at, _, _, (index, task) in planned:
+                self._wait_until(send_at)
+                self._execute_scheduled(task)
+                dispatched.append(index)
+            return dispatched
+        
+        futures = []
+        for send_at, _, device_id, (index, task) in planned:
+            self._wait_until(send_at)
+            futures.append((index, task, self.dispatcher.submit(device_id, "powerSwitch", self._execute_scheduled, task)))
+        dispatched = []
+        for index, task, future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                # 留在任务列表中，下次检查时重试（幂等日志保证不会重复执行）
+                logger.error(f"Scheduled {task.action_type} for device {task.device_id} failed: {e}")
+                continue
+            if result is not None and result.get("superseded"):
+                logger.info(f"Skipped {task.action_type} for device {task.device_id}: superseded by a newer command")
+            dispatched.append(index)
+        return dispatched
+    
+    def _wait_until(self, send_at):
+        wait_seconds = (send_at - self.clock.now(pytz.UTC)).total_seconds()
+        if wait_seconds > 0:
+            self.clock.sleep(wait_seconds)
+    
+    def _plan_dispatch(self, due_tasks):
+        """Order due tasks and assign send times using the dispatch planner
+        
+        Args:
+            due_tasks: List of (priority, sku, device_id, payload)
+        
+        Returns:
+            list: (send_at, sku, device_id, payload) sorted by send time
+        """
+        now = self.clock.now(pytz.UTC)
+        if self.dispatch_planner is None:
+            return [(now, sku, device_id, payload)
+                    for _, sku, device_id, payload in sorted(due_tasks, key=lambda item: item[0])]
+        return self.dispatch_planner.plan(due_tasks, now)
+    
+    def refresh_inventory(self, max_backoff=3600):
+        """Fetch the device list, backing off exponentially after failures
+        
+        Args:
+            max_backoff: Longest wait in seconds between failed attempts
+        
+        Returns:
+            bool: True if the device list is available
+        """
+        now = self.clock.now(pytz.UTC)
+        if self._next_inventory_attempt is not None and now < self._next_inventory_attempt:
+            return bool(self.devices)
+        result = self.get_devices()
+        if result.get("code") == 200:
+            self._inventory_backoff = 0
+            self._next_inventory_attempt = None
+            return True
+        self._inventory_backoff = min(max_backoff, max(300, self._inventory_backoff * 2))
+        self._next_inventory_attempt = now + timedelta(seconds=self._inventory_backoff)
+        logger.warning(f"Device list unavailable ({result.get('code')}), next attempt in {self._inventory_backoff} seconds")
+        return bool(self.devices)
+    
+    def start_scheduler(self, interval=300, from_timezone="America/Vancouver", stop_event=None, prewarm_lead=10,
+                        config_file=None):
         """启动定时任务调度器
         
         Args:
             interval: 检查间隔，默认300秒(5分钟)
+            from_timezone: 每日定时配置使用的时区
+            stop_event: threading.Event，设置后调度循环退出（后台线程运行时使用），为None时运行到Ctrl+C
+            prewarm_lead: 在下一次检查前多少秒预热连接，0表示不预热
+            config_file: 每日定时配置文件，为None时使用上次的路径或默认文件
         """
+        def wait(seconds):
+            if stop_event is not None:
+                self.clock.wait(stop_event, seconds)
+            else:
+                self.clock.sleep(seconds)
+        
+        lead = max(0, min(prewarm_lead, interval))
         try:
-            while True:
-                # If device list is empty, try to get devices
-                if not self.devices:
-                    self.get_devices()
-                
-                # If there are devices, set daily tasks
-                if self.devices:
-                    for device in self.devices:
-                        self.setup_daily_tasks(device["sku"], device["device"])
-                
-                # Check tasks
-                self.check_scheduled_tasks()
+            while stop_event is None or not stop_event.is_set():
+                try:
+                    # If device list is empty, try to get devices
+                    if not self.devices:
+                        self.refresh_inventory()
+                    
+                    # If there are devices, set daily tasks
+                    if self.devices:
+                        for device in self.devices:
+                            self.setup_daily_tasks(device["sku"], device["device"], from_timezone=from_timezone,
+                                                   config_file=config_file)
+                    
+                    # Check tasks
+                    self.check_scheduled_tasks()
+                except Exception as e:
+                    # Keep the loop alive, the next check retries
+                    logger.error(f"Scheduler check failed: {e}", exc_info=True)
                 
-                # Wait for next check
-                time.sleep(interval)
+                # Wait for next check, pre-warming connections shortly before it
+                if lead:
+                    wait(interval - lead)
+                    if stop_event is not None and stop_event.is_set():
+                        break
+                    try:
+                        self.prewarm_for_check(self.clock.now(pytz.UTC) + timedelta(seconds=lead))
+                    except Exception as e:
+                        logger.warning(f"Pre-warm failed: {e}")
+                    wait(lead)
+                else:
+                    wait(interval)
         except KeyboardInterrupt:
             print("调度器已停止")
-    
\ No newline at end of file
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+每日定时配置规范化
+将 openlist/closelist 转换为按时间排序的开机区间，合并重叠区间，
+标记矛盾配置并去掉不改变设备状态的冗余开关操作
+"""
+
+MINUTES_PER_DAY = 24 * 60
+
+OPEN = "open"
+CLOSE = "close"
+
+
+def parse_minutes(time_str):
+    """Convert "HH:MM" to minutes of day
+
+    Raises:
+        ValueError: The string is not a valid time of day
+    """
+    hour, minute = map(int, time_str.split(":"))
+    if not (0 <= hour <= 23 and 0 <= minute <= 59):
+        raise ValueError(f"time out of range: {time_str}")
+    return hour * 60 + minute
+
+
+def format_minutes(minutes):
+    """Format minutes of day in the config file style, e.g. 7:00"""
+    minutes %= MINUTES_PER_DAY
+    return f"{minutes // 60}:{minutes % 60:02d}"
+
+
+def normalize_schedule(open_times, close_times):
+    """Normalize one device's daily open/close lists
+
+    The schedule repeats every day, so the state at midnight is the state
+    left by the last transition of the day. Sorting dominates, O(n log n).
+
+    Args:
+        open_times: "HH:MM" strings from openlist
+        close_times: "HH:MM" strings from closelist
+
+    Returns:
+        dict: {
+            "open": normalized open times,
+            "close": normalized close times,
+            "windows": [(start_minute, end_minute)] on-windows, end > 1440 when
+                a window runs past midnight,
+            "issues": human readable descriptions of what was dropped
+        }
+    """
+    issues = []
+    events = {}
+    for action, time_strs in ((OPEN, open_times), (CLOSE, close_times)):
+        for time_str in time_strs:
+            time_str = time_str.strip()
+            if not time_str:
+                continue
+            try:
+                minute = parse_minutes(time_str)
+            except ValueError:
+                issues.append(f"invalid {action} time {time_str!r} ignored")
+                continue
+            actions = events.setdefault(minute, set())
+            if action in actions:
+                issues.append(f"duplicate {action} at {format_minutes(minute)} dropped")
+            actions.add(action)
+
+    transitions = []
+    for minute in sorted(events):
+        actions = events[minute]
+        if len(actions) > 1:
+            issues.append(f"open and close both at {format_minutes(minute)}, both dropped")
+            continue
+        transitions.append((minute, actions.pop()))
+
+    if not transitions:
+        return {"open": [], "close": [], "windows": [], "issues": issues}
+
+    # 只有开机或只有关机时，保留当天第一次操作即可
+    if len({action for _, action in transitions}) == 1:
+        for minute, action in transitions[1:]:
+            issues.append(f"redundant {action} at {format_minutes(minute)} dropped")
+        transitions = transitions[:1]
+    else:
+        state = transitions[-1][1]
+        kept = []
+        for minute, action in transitions:
+            if action == state:
+                issues.append(f"redundant {action} at {format_minutes(minute)} dropped (already {state})")
+                continue
+            kept.append((minute, action))
+            state = action
+        transitions = kept
+
+    windows = []
+    if any(action == CLOSE for _, action in transitions):
+        for index, (minute, action) in enumerate(transitions):
+            if action != OPEN:
+                continue
+            # 开机后的下一次操作一定是关机；最后一次开机的关机在次日
+            if index + 1 < len(transitions):
+                windows.append((minute, transitions[index + 1][0]))
+            else:
+                windows.append((minute, transitions[0][0] + MINUTES_PER_DAY))
+
+    return {
+        "open": [format_minutes(minute) for minute, action in transitions if action == OPEN],
+        "close": [format_minutes(minute) for minute, action in transitions if action == CLOSE],
+        "windows": windows,
+        "issues": issues,
+    }
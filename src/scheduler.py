@@ -8,9 +8,22 @@
 import os
 import sys
 import time
+import queue
+import signal
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from request import Request
+from dispatch import DispatchPlanner
+from journal import CommandJournal
+from control_socket import ControlServer, ControlError, connect_to_daemon, socket_in_use
+from events import DeviceStateTable, EventSubscriber
+from quota import QuotaAccountant
+from ratelimit import TokenBucket
+from keypool import ApiKeyPool
+from concurrency import AdaptiveConcurrencyLimiter
+from verify import CommandVerifier
+from history import ExecutionHistory
+from profiling import timings, SamplingProfiler
 import config
 import pytz
 import threading
@@ -21,6 +34,16 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 log_file = os.path.join(current_dir, "ice_maker_scheduler.log")
 # PID文件路径
 pid_file = os.path.join(current_dir, "ice_maker_scheduler.pid")
+# 命令日志路径
+journal_file = os.path.join(current_dir, config.command_journal)
+# 控制套接字路径
+socket_file = os.path.join(current_dir, config.control_socket)
+# API配额计数文件路径
+quota_file = os.path.join(current_dir, config.quota_state_file)
+# 命令执行历史文件路径
+history_file = os.path.join(current_dir, config.history_file)
+# 采样分析结果路径（collapsed stack格式，可直接用flamegraph.pl生成火焰图）
+profile_file = os.path.join(current_dir, "ice_maker_scheduler.profile.txt")
 
 # 配置日志
 logging.basicConfig(
@@ -74,6 +97,52 @@ def display_current_times():
     logger.info(f"Vancouver Time: {now_vancouver.strftime('%H:%M:%S')}")
     logger.info(f"Shanghai Time: {now_shanghai.strftime('%H:%M:%S')}")
 
+def log_timings():
+    """Write the per-phase timing summary to the log"""
+    logger.info("Phase timings (rolling window):")
+    for line in timings.format_summary():
+        logger.info(line)
+
+def toggle_profiler(profiler):
+    """Start the sampling profiler, or stop it and write the samples to profile_file"""
+    with profiler.lock:
+        if profiler.start():
+            logger.info("Sampling profiler started, send the same signal again to stop")
+            return
+        result = profiler.stop()
+        profiler.write(profile_file)
+        top = profiler.top(10)
+    logger.info(f"Sampling profiler stopped after {result['seconds']:.1f} seconds, "
+                f"{result['samples']} samples written to {profile_file}")
+    for function, samples in top:
+        logger.info(f" - {samples:>6} {function}")
+
+def install_profiling_signals(profiler):
+    """SIGUSR1 logs the phase timings, SIGUSR2 starts/stops the sampling profiler
+    
+    Signal handlers run on the main thread, possibly while it holds the
+    timings or profiler lock, so they only queue the request; a helper
+    thread does the work. SimpleQueue.put is safe to call from a handler.
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    pending = queue.SimpleQueue()
+    
+    def handle_requests():
+        while True:
+            signum = pending.get()
+            try:
+                if signum == signal.SIGUSR1:
+                    log_timings()
+                else:
+                    toggle_profiler(profiler)
+            except Exception as e:
+                logger.error(f"Handling signal {signum} failed: {e}", exc_info=True)
+    
+    threading.Thread(target=handle_requests, name="signal-requests", daemon=True).start()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: pending.put(signum))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: pending.put(signum))
+
 def run_scheduler():
     """Run the scheduler to manage ice maker"""
     # Load config
@@ -84,6 +153,11 @@ def run_scheduler():
     daily_control_time_file = config.daily_control_time_load
     timezone = config.timezone
     
+    # Two schedulers would dispatch the same tasks twice
+    if os.name == 'posix' and socket_in_use(socket_file):
+        logger.error(f"Another scheduler is already running (listening on {socket_file}), not starting")
+        return
+    
     # Convert timezone format
     from_timezone = verify_timezone_mapping(timezone)
     
@@ -94,49 +168,197 @@ def run_scheduler():
     # Display current time in different timezones
     display_current_times()
     
-    # Initialize request object
-    ice_maker = Request(api_key, api_key_value)
+    # Initialize one request object per Govee account
+    planner = DispatchPlanner(window=config.dispatch_window, tolerance=config.dispatch_tolerance)
+    journal = CommandJournal(journal_file)
+    state_table = DeviceStateTable()
+    quota = QuotaAccountant(daily_limit=config.daily_request_limit, state_file=quota_file)
+    verifier = CommandVerifier(state_table=state_table) if config.verify_commands else None
+    history = ExecutionHistory(history_file, per_device=config.history_per_device)
+    # The primary key comes first; config.accounts adds further accounts
+    accounts = [{"name": "default", "api_key_value": api_key_value}]
+    accounts += [account for account in config.accounts if account["api_key_value"] != api_key_value]
+    pool = ApiKeyPool()
+    for account in accounts:
+        ice_maker = Request(api_key, account["api_key_value"], dispatch_planner=planner, journal=journal,
+                            state_table=state_table, quota=quota,
+                            rate_limiter=TokenBucket(config.rate_limit_per_minute),
+                            concurrency=AdaptiveConcurrencyLimiter(max_limit=config.max_concurrency),
+                            verifier=verifier, history=history)
+        pool.add(account.get("name", "default"), ice_maker,
+                 device_ids=None if config.accounts else [device_id])
     
-    # Check if we can connect to the device
-    devices_result = ice_maker.get_devices()
-    if devices_result["code"] != 200:
-        logger.error(f"Failed to get devices: {devices_result}")
+    # Check if we can connect to the devices
+    if pool.refresh() == 0:
+        logger.error("Failed to get devices for every account")
         logger.error("Check API key and network connection")
         return
     
-    logger.info("Device connection successful")
+    logger.info(f"Device connection successful ({len(pool)} account(s))")
+    
+    def setup_all_daily_tasks():
+        """Set up daily tasks for the configured device, or every device of every account"""
+        if config.accounts:
+            pool.refresh()
+            targets = [(ice_maker, device["sku"], device["device"]) for _, ice_maker, device in pool.devices()]
+        else:
+            targets = [(pool.route(device_id), sku, device_id)]
+        for ice_maker, target_sku, target_device in targets:
+            ice_maker.setup_daily_tasks(target_sku, target_device, from_timezone=from_timezone,
+                                        config_file=daily_control_time_file)
     
     # Set up initial daily tasks
-    ice_maker.setup_daily_tasks(sku, device_id, from_timezone=from_timezone, 
-                              config_file=daily_control_time_file)
+    setup_all_daily_tasks()
+    
+    # Subscribe to pushed device events
+    subscribers = []
+    if config.event_subscription:
+        for name, ice_maker in pool.accounts:
+            subscriber = EventSubscriber(ice_maker.api_key_value, state_table)
+            try:
+                subscriber.start()
+                subscribers.append(subscriber)
+            except RuntimeError as e:
+                logger.warning(f"Event subscription disabled: {e}")
+                break
+    
+    # Profiling can be toggled at runtime by signal or through the control socket
+    profiler = SamplingProfiler()
+    install_profiling_signals(profiler)
+    
+    # Expose control socket for main.py and other local clients
+    control_server = None
+    if os.name == 'posix':
+        control_server = ControlServer(pool, socket_file, profiler=profiler, profile_path=profile_file)
+        try:
+            control_server.start()
+        except RuntimeError as e:
+            # 另一个调度器在启动检查之后抢先绑定了套接字
+            logger.error(f"{e}, not starting")
+            for subscriber in subscribers:
+                subscriber.stop()
+            return
     
     # Run first check immediately
     logger.info("Running initial task check")
-    ice_maker.check_scheduled_tasks()
+    pool.check_scheduled_tasks()
     
     # Set up periodic task checking
     interval = 300  # 5 minutes in seconds
     logger.info(f"Starting scheduler loop with {interval} seconds interval")
     
+    lead = max(0, min(config.prewarm_lead, interval))
+    
     try:
         while True:
-            # Wait for the next interval
-            time.sleep(interval)
-            
-            # Set up daily tasks again in case of changes
-            ice_maker.setup_daily_tasks(sku, device_id, from_timezone=from_timezone,
-                                       config_file=daily_control_time_file)
-            
-            # Display current time for debugging
-            display_current_times()
+            # Wait for the next interval, pre-warming connections shortly before the check
+            next_check = time.monotonic() + interval
+            if lead:
+                time.sleep(max(0, next_check - lead - time.monotonic()))
+                try:
+                    with timings.phase("tick.prewarm"):
+                        pool.prewarm_for_check(datetime.now(pytz.UTC) + timedelta(seconds=lead))
+                except Exception as e:
+                    logger.warning(f"Pre-warm failed: {e}")
+            time.sleep(max(0, next_check - time.monotonic()))
             
-            # Check scheduled tasks
-            ice_maker.check_scheduled_tasks()
+            # A failed check is logged and retried at the next interval instead of stopping the daemon
+            try:
+                with timings.phase("tick"):
+                    # Set up daily tasks again in case of changes
+                    with timings.phase("tick.setup_daily_tasks"):
+                        setup_all_daily_tasks()
+                    
+                    # Display current time for debugging
+                    with timings.phase("tick.display_times"):
+                        display_current_times()
+                    
+                    # Check scheduled tasks
+                    with timings.phase("tick.check_tasks"):
+                        pool.check_scheduled_tasks()
+                    
+                    # Append this interval's command outcomes to the history file
+                    with timings.phase("tick.history"):
+                        history.flush()
+            except Exception as e:
+                logger.error(f"Scheduler check failed: {e}", exc_info=True)
             
     except KeyboardInterrupt:
         logger.info("Scheduler stopped by user")
     except Exception as e:
         logger.error(f"Scheduler error: {e}", exc_info=True)
+    finally:
+        if verifier is not None:
+            verifier.stop()
+        for _, ice_maker in pool.accounts:
+            if ice_maker.dispatcher is not None:
+                ice_maker.dispatcher.shutdown()
+        if profiler.running:
+            toggle_profiler(profiler)
+        quota.save()
+        history.flush()
+        if control_server is not None:
+            control_server.stop()
+        for subscriber in subscribers:
+            subscriber.stop()
+
+def query_daemon_profiling(show_timings=False, profile_action=None):
+    """Show the running daemon's phase timings and/or start/stop its profiler"""
+    daemon = connect_to_daemon(socket_file)
+    if daemon is None:
+        print(f"No scheduler daemon is listening on {socket_file}")
+        return False
+    try:
+        if show_timings:
+            for line in daemon.call("timings")["lines"]:
+                print(line)
+        if profile_action == "start":
+            daemon.call("profile", action="start")
+            print("Sampling profiler started")
+        elif profile_action == "stop":
+            result = daemon.call("profile", action="stop")
+            print(f"Sampling profiler stopped after {result['seconds']:.1f} seconds, "
+                  f"{result['samples']} samples written to {result['path']}")
+            for function, samples in result["top"]:
+                print(f"{samples:>8} {function}")
+        return True
+    except ControlError as e:
+        print(f"Scheduler daemon rejected the request: {e}")
+        return False
+    finally:
+        daemon.close()
+
+def print_history(status):
+    """Print one device's history status as returned by ExecutionHistory.status"""
+    print(f"Device {status['device']}: {status['total']} command(s), {status['failures']} failed")
+    for record in status["recent"]:
+        print(f"  {record['at']}  {record['kind']:<13} {record['instance']}={record['value']:<4} "
+              f"code {record['code']:<4} {record['latency_ms']:.0f} ms")
+
+def query_history(device_id, limit=10):
+    """Show a device's recent commands from the running daemon, or from the history file"""
+    daemon = connect_to_daemon(socket_file)
+    if daemon is not None:
+        try:
+            print_history(daemon.call("history", device=device_id, limit=limit))
+            return True
+        except ControlError as e:
+            print(f"Scheduler daemon rejected the request: {e}")
+            return False
+        finally:
+            daemon.close()
+    
+    # 没有运行中的守护进程时读取历史文件（当前文件和轮转后的 .1 文件）
+    history = ExecutionHistory(per_device=limit)
+    for path in (f"{history_file}.1", history_file):
+        if os.path.exists(path):
+            history.load(path, device_id=device_id)
+    status = history.status(device_id, limit=limit)
+    if status is None:
+        print(f"No command history for device {device_id}")
+        return False
+    print_history(status)
+    return True
 
 def run_as_daemon():
     """以守护进程方式运行（仅支持Linux/Unix系统）"""
@@ -243,9 +465,16 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='冰块制造机定时任务调度器')
     parser.add_argument('-d', '--daemon', action='store_true', help='以守护进程模式运行（仅Linux/Unix）')
     parser.add_argument('-s', '--systemd', action='store_true', help='创建systemd服务文件（仅Linux）')
+    parser.add_argument('--timings', action='store_true', help='显示正在运行的调度器各阶段耗时')
+    parser.add_argument('--profile', choices=['start', 'stop'], help='开始/停止正在运行的调度器的采样分析')
+    parser.add_argument('--history', metavar='DEVICE', help='显示设备最近的命令执行记录')
     args = parser.parse_args()
     
-    if args.systemd:
+    if args.history:
+        query_history(args.history)
+    elif args.timings or args.profile:
+        query_daemon_profiling(show_timings=args.timings, profile_action=args.profile)
+    elif args.systemd:
         create_systemd_service()
     elif args.daemon:
         run_as_daemon()
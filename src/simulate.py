@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+调度器模拟器
+使用虚拟时钟和桩传输层快进运行调度循环，几秒内即可回放数月的定时任务，
+并报告每一次下发的命令及其时间
+"""
+
+import sys
+import logging
+import threading
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+from request import Request
+from clock import VirtualClock
+from dispatch import DispatchPlanner
+from schedule import normalize_schedule
+import config
+import pytz
+
+
+class StubResponse:
+    """Minimal stand-in for requests.Response"""
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+        self.text = str(body)
+
+    def json(self):
+        return self._body
+
+
+class StubTransport:
+    """Offline replacement for the requests module
+
+    Answers the Govee endpoints with canned success responses and records
+    every control command together with the (virtual) time it was sent.
+    """
+
+    def __init__(self, clock, devices):
+        self.clock = clock
+        self.devices = devices
+        # 下发记录 [(UTC时间, sku, 设备ID, 能力实例, 值)]
+        self.dispatches = []
+
+    def get(self, url, headers=None, **kwargs):
+        if url.endswith("/user/devices"):
+            return StubResponse(200, {"code": 200, "message": "success", "data": self.devices})
+        return StubResponse(404, {"code": 404, "message": "not found"})
+
+    def post(self, url, headers=None, json=None, **kwargs):
+        payload = (json or {}).get("payload", {})
+        capability = payload.get("capability", {})
+        self.dispatches.append((
+            self.clock.now(pytz.UTC),
+            payload.get("sku"),
+            payload.get("device"),
+            capability.get("instance"),
+            capability.get("value"),
+        ))
+        return StubResponse(200, {
+            "requestId": (json or {}).get("requestId"),
+            "msg": "success",
+            "code": 200,
+            "capability": dict(capability, state={"status": "success"}),
+        })
+
+
+def run_simulation(start, days, config_file, from_timezone="America/Vancouver",
+                   devices=None, interval=300, host_timezone=None, dispatch_window=0):
+    """Replay Request.start_scheduler against a virtual clock
+
+    The real scheduler loop runs, including the inventory refresh and the
+    connection pre-warm before each check; a timer on the virtual clock
+    stops it at the end time.
+
+    Args:
+        start: Naive start time, interpreted in host_timezone
+        days: Number of days to simulate
+        config_file: Daily schedule file (openlist/closelist)
+        from_timezone: Timezone the schedule times are written in
+        devices: Device inventory returned by the stub, default is the device from config
+        interval: Scheduler tick in seconds, default 300 as in production
+        host_timezone: Timezone of the simulated server, default is from_timezone
+        dispatch_window: Seconds over which simultaneous commands are spread, 0 sends at once
+
+    Returns:
+        list: Dispatch records (utc_time, sku, device_id, instance, value)
+    """
+    if devices is None:
+        devices = [{"sku": config.sku, "device": config.device, "deviceName": "Simulated Ice Maker"}]
+
+    clock = VirtualClock(start, local_timezone=host_timezone or from_timezone)
+    transport = StubTransport(clock, devices)
+    planner = DispatchPlanner(window=dispatch_window, tolerance=config.dispatch_tolerance)
+    ice_maker = Request(config.api_key, "simulated", clock=clock, transport=transport,
+                        dispatch_planner=planner)
+
+    stop_event = threading.Event()
+    clock.call_at(clock.now(pytz.UTC) + timedelta(days=days), stop_event.set)
+    ice_maker.start_scheduler(interval=interval, from_timezone=from_timezone, stop_event=stop_event,
+                              prewarm_lead=config.prewarm_lead, config_file=config_file)
+
+    return transport.dispatches
+
+
+def summarize_by_day(dispatches, expected_per_day, report_timezone, first_day, last_day):
+    """Group dispatches per local day and flag days that deviate from the schedule
+
+    Args:
+        dispatches: Records returned by run_simulation
+        expected_per_day: Expected number of commands per device per day
+        report_timezone: Timezone used to decide which day a dispatch belongs to
+        first_day: First simulated day (inclusive)
+        last_day: Last simulated day (inclusive)
+
+    Returns:
+        list: (date, device_id, count) for every day whose count differs from expected_per_day
+    """
+    tz = pytz.timezone(report_timezone)
+    counts = defaultdict(int)
+    device_ids = set()
+    for utc_time, _, device_id, _, _ in dispatches:
+        counts[(utc_time.astimezone(tz).date(), device_id)] += 1
+        device_ids.add(device_id)
+
+    anomalies = []
+    day = first_day
+    while day <= last_day:
+        for device_id in sorted(device_ids):
+            count = counts.get((day, device_id), 0)
+            if count != expected_per_day:
+                anomalies.append((day, device_id, count))
+        day += timedelta(days=1)
+    return anomalies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='冰块制造机调度器模拟（虚拟时钟）')
+    parser.add_argument('--start', default=None, help='模拟开始日期 YYYY-MM-DD，默认为今天')
+    parser.add_argument('--days', type=int, default=365, help='模拟天数，默认365天')
+    parser.add_argument('--config', default=config.daily_control_time_load, help='每日定时任务配置文件')
+    parser.add_argument('--timezone', default='America/Vancouver', help='配置文件中时间所属的时区')
+    parser.add_argument('--host-timezone', default=None, help='模拟服务器所在时区，默认与--timezone相同')
+    parser.add_argument('--interval', type=int, default=300, help='调度检查间隔（秒）')
+    parser.add_argument('--dispatch-window', type=int, default=config.dispatch_window, help='同时到期命令的分散窗口（秒）')
+    parser.add_argument('-q', '--quiet', action='store_true', help='只输出汇总与异常，不逐条列出下发记录')
+    parser.add_argument('-v', '--verbose', action='store_true', help='输出调度器日志')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(levelname)s - %(message)s')
+
+    if args.start:
+        start = datetime.strptime(args.start, "%Y-%m-%d")
+    else:
+        start = datetime.combine(datetime.now().date(), datetime.min.time())
+
+    dispatches = run_simulation(start, args.days, args.config, from_timezone=args.timezone,
+                                interval=args.interval, host_timezone=args.host_timezone,
+                                dispatch_window=args.dispatch_window)
+
+    shanghai = pytz.timezone("Asia/Shanghai")
+    local = pytz.timezone(args.timezone)
+    if not args.quiet:
+        for utc_time, sku, device_id, instance, value in dispatches:
+            print(f"{utc_time.strftime('%Y-%m-%d %H:%M:%S')} UTC | "
+                  f"{utc_time.astimezone(local).strftime('%Y-%m-%d %H:%M')} ({args.timezone}) | "
+                  f"{utc_time.astimezone(shanghai).strftime('%Y-%m-%d %H:%M')} (Asia/Shanghai) | "
+                  f"{sku} {device_id} {instance}={value}")
+
+    times = Request(config.api_key, "simulated").read_daily_controller_times(args.config)
+    normalized = normalize_schedule(times["open"], times["close"])
+    expected = len(normalized["open"]) + len(normalized["close"])
+    first_day = start.date()
+    last_day = first_day + timedelta(days=args.days - 1)
+    anomalies = summarize_by_day(dispatches, expected, args.timezone, first_day, last_day)
+
+    print(f"\nSimulated {args.days} days: {len(dispatches)} dispatches, "
+          f"expected {expected} per device per day")
+    if anomalies:
+        print(f"{len(anomalies)} day(s) deviate from the schedule:")
+        for day, device_id, count in anomalies:
+            print(f"  {day} {device_id}: {count} dispatches")
+        return 1
+    print("No anomalies found")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+线程安全的定时任务存储
+调度线程、交互菜单和控制套接字可以同时读写任务列表。
+任务使用紧凑的 __slots__ 记录：整数动作、驻留(intern)的设备字符串和整数 UTC 时间戳，
+按设备分组保存，数十万个任务也能快速扫描
+"""
+
+import sys
+import time
+import threading
+from enum import IntEnum
+from datetime import datetime
+import pytz
+from journal import KEY_TIME_FORMAT
+
+# Action 的每日任务标志位
+DAILY_FLAG = 2
+
+
+class Action(IntEnum):
+    """Task action; bit 0 is the power direction, bit 1 marks daily tasks"""
+
+    OPEN = 0
+    CLOSE = 1
+    DAILY_OPEN = 2
+    DAILY_CLOSE = 3
+
+    @classmethod
+    def parse(cls, action_type):
+        """Action from its string form ("open", "close", "daily_open", "daily_close")
+
+        Raises:
+            ValueError: Unknown action type
+        """
+        try:
+            return cls[action_type.upper()]
+        except KeyError:
+            raise ValueError(f"Unknown action type: {action_type}") from None
+
+    @property
+    def label(self):
+        """String form used in logs, idempotency keys and the control socket"""
+        return self.name.lower()
+
+    @property
+    def power_status(self):
+        """1 for power on, 0 for power off"""
+        return 0 if self & 1 else 1
+
+
+class Task:
+    """One scheduled power command"""
+
+    __slots__ = ("sku", "device_id", "action", "epoch")
+
+    def __init__(self, sku, device_id, action, epoch):
+        """
+        Args:
+            sku: Device model
+            device_id: Device ID
+            action: Action
+            epoch: Target time as integer seconds since the epoch (UTC)
+        """
+        # 同一设备的所有任务共享同一个字符串对象
+        self.sku = sys.intern(sku)
+        self.device_id = sys.intern(device_id)
+        self.action = action
+        self.epoch = epoch
+
+    @classmethod
+    def create(cls, sku, device_id, action_type, target_time_utc):
+        """Task from the string action and aware datetime used by the public API"""
+        return cls(sku, device_id, Action.parse(action_type), int(target_time_utc.timestamp()))
+
+    @property
+    def action_type(self):
+        return self.action.label
+
+    @property
+    def target_time(self):
+        """Target time as an aware UTC datetime"""
+        return datetime.fromtimestamp(self.epoch, pytz.UTC)
+
+    @property
+    def key(self):
+        """Idempotency key, same as journal.task_key for this task"""
+        return f"{self.sku}|{self.device_id}|{self.action.label}|{time.strftime(KEY_TIME_FORMAT, time.gmtime(self.epoch))}"
+
+    def __repr__(self):
+        return f"Task({self.sku!r}, {self.device_id!r}, {self.action.label}, {self.target_time.isoformat()})"
+
+
+class TaskStore:
+    """Lock-protected scheduled tasks, grouped by device
+
+    Readers always get a snapshot, so a scheduler check can iterate and
+    dispatch without holding the lock while other threads add or cancel tasks.
+    Replacing one device's daily tasks only touches that device's list.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # 设备ID -> [Task]
+        self._by_device = {}
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(tasks) for tasks in self._by_device.values())
+
+    def snapshot(self):
+        """Copy of the current task list"""
+        with self._lock:
+            return [task for tasks in self._by_device.values() for task in tasks]
+
+    def add(self, task):
+        with self._lock:
+            self._by_device.setdefault(task.device_id, []).append(task)
+
+    def replace_daily(self, device_id, daily_tasks):
+        """Replace a device's daily tasks, leaving one-time and other devices' tasks alone"""
+        with self._lock:
+            tasks = [task for task in self._by_device.get(device_id, ()) if not task.action & DAILY_FLAG]
+            tasks.extend(daily_tasks)
+            self._store(device_id, tasks)
+
+    def remove(self, tasks):
+        """Remove the given task objects (by identity); tasks added meanwhile are kept
+
+        Returns:
+            int: Number of removed tasks
+        """
+        finished = {}
+        for task in tasks:
+            finished.setdefault(task.device_id, set()).add(id(task))
+        removed = 0
+        with self._lock:
+            for device_id, ids in finished.items():
+                current = self._by_device.get(device_id, ())
+                remaining = [task for task in current if id(task) not in ids]
+                removed += len(current) - len(remaining)
+                self._store(device_id, remaining)
+        return removed
+
+    def remove_where(self, predicate, device_id=None):
+        """Remove every task for which predicate(task) is true
+
+        Args:
+            predicate: Function of a Task
+            device_id: Only look at this device's tasks
+
+        Returns:
+            int: Number of removed tasks
+        """
+        removed = 0
+        with self._lock:
+            if device_id is None:
+                groups = list(self._by_device.items())
+            else:
+                groups = [(device_id, self._by_device.get(device_id, []))]
+            for device_id, current in groups:
+                remaining = [task for task in current if not predicate(task)]
+                if len(remaining) != len(current):
+                    removed += len(current) - len(remaining)
+                    self._store(device_id, remaining)
+        return removed
+
+    def _store(self, device_id, tasks):
+        if tasks:
+            self._by_device[device_id] = tasks
+        else:
+            self._by_device.pop(device_id, None)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+命令执行确认
+/device/control 返回 "status": "success" 只表示云端接受了命令，制冰机不一定执行。
+命令成功后登记期望状态，由后台线程轮询设备状态确认：轮询间隔先短后长（指数退避），
+多次仍未生效时重新发送命令。同一设备的多个待确认命令合并为一次状态查询，
+已通过事件推送确认的命令不再查询；轮询计入每日配额，配额不足时推迟
+"""
+
+import logging
+import threading
+from datetime import datetime
+import pytz
+from clock import SystemClock
+
+logger = logging.getLogger(__name__)
+
+
+def state_matches(expected, actual):
+    """Whether a reported capability value satisfies the commanded one
+
+    STRUCT values (workMode) only compare the fields the device reports.
+    """
+    if isinstance(expected, dict):
+        if not isinstance(actual, dict):
+            return False
+        fields = [field for field in expected if field in actual]
+        return bool(fields) and all(actual[field] == expected[field] for field in fields)
+    return expected == actual
+
+
+class _Expectation:
+    __slots__ = ("sku", "device_id", "instance", "value", "poll", "resend",
+                 "issued_at", "started", "attempt", "reissues", "next_at")
+
+    def __init__(self, sku, device_id, instance, value, poll, resend, issued_at, started):
+        self.sku = sku
+        self.device_id = device_id
+        self.instance = instance
+        self.value = value
+        self.poll = poll
+        self.resend = resend
+        self.issued_at = issued_at
+        self.started = started
+        self.attempt = 0
+        self.reissues = 0
+        self.next_at = started
+
+
+class CommandVerifier:
+    """Background confirmation loop for accepted control commands"""
+
+    def __init__(self, state_table=None, initial_delay=2, factor=2, max_delay=60, max_polls=5,
+                 max_reissues=1, max_polls_per_round=20, clock=None, background=True):
+        """
+        Args:
+            state_table: DeviceStateTable; a pushed event newer than the command confirms it without polling
+            initial_delay: Seconds before the first poll
+            factor: Growth of the delay after every poll that does not confirm the command
+            max_delay: Longest delay between polls
+            max_polls: Polls per issue of a command before it is re-issued
+            max_reissues: Times a command is re-issued before verification gives up
+            max_polls_per_round: Devices polled per round, the rest wait initial_delay seconds for the next round
+            clock: Clock for poll times and confirmation timestamps, default is the system clock
+            background: Poll on a background thread started by the first expect(); with False
+                the owner calls run_due(), e.g. after every step of a virtual clock
+        """
+        self.state_table = state_table
+        self.initial_delay = initial_delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.max_polls = max_polls
+        self.max_reissues = max_reissues
+        self.max_polls_per_round = max_polls_per_round
+        self.clock = clock or SystemClock()
+        self.background = background
+        # (设备ID, 能力实例) -> _Expectation
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self.stats = {"confirmed": 0, "reissued": 0, "failed": 0, "polls": 0, "superseded": 0}
+
+    def _now(self):
+        """Current clock time in seconds; poll times are kept in this scale"""
+        return self.clock.now(pytz.UTC).timestamp()
+
+    def delay(self, attempt):
+        """Seconds until the poll after the given number of unconfirmed polls"""
+        return min(self.max_delay, self.initial_delay * self.factor ** attempt)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="verifier", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def expect(self, sku, device_id, instance, value, poll, resend):
+        """Register an accepted command for confirmation
+
+        A newer command for the same device and capability replaces the
+        pending one, so a stale value is never re-issued.
+
+        Args:
+            poll: poll(sku, device_id) -> API result of the device state query
+            resend: resend() issues the command again
+        """
+        issued_at = self.clock.now(pytz.UTC)
+        now = issued_at.timestamp()
+        expectation = _Expectation(sku, device_id, instance, value, poll, resend, issued_at, now)
+        expectation.next_at = now + self.delay(0)
+        with self._condition:
+            if (device_id, instance) in self._pending:
+                self.stats["superseded"] += 1
+            self._pending[(device_id, instance)] = expectation
+            self._condition.notify_all()
+        if self.background:
+            self.start()
+
+    def pending(self):
+        """Number of commands awaiting confirmation"""
+        with self._condition:
+            return len(self._pending)
+
+    def summary(self):
+        with self._condition:
+            return dict(self.stats, pending=len(self._pending))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    now = self._now()
+                    next_at = min((entry.next_at for entry in self._pending.values()), default=None)
+                    if next_at is not None and next_at <= now:
+                        break
+                    self._condition.wait(None if next_at is None else next_at - now)
+                if self._stopped:
+                    return
+            self.run_due()
+
+    def run_due(self):
+        """Run one round: poll the devices whose commands are due
+
+        Returns:
+            int: Number of devices checked
+        """
+        with self._condition:
+            now = self._now()
+            # 同一设备的到期命令合并为一次状态查询
+            devices = {}
+            for entry in sorted(self._pending.values(), key=lambda entry: entry.next_at):
+                if entry.next_at <= now:
+                    devices.setdefault(entry.device_id, []).append(entry)
+        groups = list(devices.values())
+        checked = 0
+        for entries in groups[:self.max_polls_per_round]:
+            checked += 1
+            try:
+                if not self._check_device(entries):
+                    # 配额不足，本轮剩余的设备也推迟
+                    break
+            except Exception as e:
+                logger.error(f"Verification of device {entries[0].device_id} failed: {e}", exc_info=True)
+                for entry in entries:
+                    self._retry(entry, self._now())
+        self._defer([entry for entries in groups[checked:] for entry in entries])
+        return checked
+
+    def _defer(self, entries):
+        """Move entries left over from a round to the next round instead of polling them right away"""
+        if not entries:
+            return
+        next_round = self._now() + self.initial_delay
+        with self._condition:
+            for entry in entries:
+                if self._pending.get((entry.device_id, entry.instance)) is entry:
+                    entry.next_at = max(entry.next_at, next_round)
+
+    def _check_device(self, entries):
+        """Confirm, re-poll or re-issue the due commands of one device
+
+        Returns:
+            bool: False when the daily quota refused the poll
+        """
+        unconfirmed = [entry for entry in entries if not self._confirmed_by_event(entry)]
+        for entry in entries:
+            if entry not in unconfirmed:
+                self._finish(entry, "event")
+        if not unconfirmed:
+            return True
+
+        first = unconfirmed[0]
+        result = first.poll(first.sku, first.device_id)
+        now = self._now()
+        if result.get("throttled_locally"):
+            with self._condition:
+                for entry in unconfirmed:
+                    entry.next_at = now + self.delay(entry.attempt)
+            return False
+        with self._condition:
+            self.stats["polls"] += 1
+
+        reported = {}
+        if result.get("code") == 200:
+            for capability in (result.get("payload") or {}).get("capabilities", []):
+                reported[capability.get("instance")] = (capability.get("state") or {}).get("value")
+        for entry in unconfirmed:
+            if entry.instance in reported and state_matches(entry.value, reported[entry.instance]):
+                self._finish(entry, "poll")
+            else:
+                self._retry(entry, now)
+        return True
+
+    def _confirmed_by_event(self, entry):
+        if self.state_table is None:
+            return False
+        state = self.state_table.get(entry.device_id, entry.instance)
+        if not state or state["source"] != "event":
+            return False
+        return (datetime.fromisoformat(state["updated_at"]) > entry.issued_at
+                and state_matches(entry.value, state["value"]))
+
+    def _finish(self, entry, source):
+        with self._condition:
+            if self._pending.get((entry.device_id, entry.instance)) is not entry:
+                return
+            del self._pending[(entry.device_id, entry.instance)]
+            self.stats["confirmed"] += 1
+        logger.info(f"Confirmed {entry.instance}={entry.value} on device {entry.device_id} "
+                    f"by {source} after {self._now() - entry.started:.1f} seconds")
+
+    def _retry(self, entry, now):
+        with self._condition:
+            if self._pending.get((entry.device_id, entry.instance)) is not entry:
+                return
+            entry.attempt += 1
+            if entry.attempt < self.max_polls:
+                entry.next_at = now + self.delay(entry.attempt)
+                return
+            if entry.reissues >= self.max_reissues:
+                del self._pending[(entry.device_id, entry.instance)]
+                self.stats["failed"] += 1
+                logger.error(f"Device {entry.device_id} did not apply {entry.instance}={entry.value} "
+                             f"after {entry.reissues} re-issue(s), giving up")
+                return
+            entry.reissues += 1
+            entry.attempt = 0
+            entry.issued_at = self.clock.now(pytz.UTC)
+            entry.next_at = now + self.delay(0)
+            self.stats["reissued"] += 1
+        logger.warning(f"Device {entry.device_id} has not applied {entry.instance}={entry.value}, "
+                       f"re-issuing the command")
+        entry.resend()
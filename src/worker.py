@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+交互程序的后台线程
+SchedulerWorker 在后台线程中运行定时任务调度循环，菜单保持可用
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerWorker:
+    """Run Request.start_scheduler on a background thread"""
+
+    def __init__(self, ice_maker, from_timezone="America/Vancouver", interval=300):
+        """
+        Args:
+            ice_maker: Request whose tasks are checked
+            from_timezone: Timezone of the daily schedule config
+            interval: Seconds between task checks
+        """
+        self.ice_maker = ice_maker
+        self.from_timezone = from_timezone
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self.ice_maker.start_scheduler,
+            kwargs={"interval": self.interval, "from_timezone": self.from_timezone,
+                    "stop_event": self._stop_event},
+            name="scheduler", daemon=True)
+        self._thread.start()
+        logger.info(f"Scheduler thread started, checking every {self.interval} seconds")
+
+    def stop(self, timeout=None):
+        """Ask the loop to exit and wait for the current check to finish
+
+        Returns:
+            bool: True if the thread has exited
+        """
+        if self._thread is None:
+            return True
+        self._stop_event.set()
+        self._thread.join(timeout)
+        stopped = not self._thread.is_alive()
+        if stopped:
+            self._thread = None
+            logger.info("Scheduler thread stopped")
+        return stopped
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 模块位于 src/ 下并以顶层模块方式互相导入
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,105 @@
+import pytest
+
+import concurrency
+from concurrency import AdaptiveConcurrencyLimiter
+
+
+class FakeTime:
+    """Replaces the time module inside concurrency, advanced by hand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(concurrency, "time", fake)
+    return fake
+
+
+def run_calls(limiter, fake_time, calls, latency, overloaded=False):
+    """Keep every slot busy: each finished call is replaced by a new one right away
+
+    Every call takes exactly latency seconds, as with a steady queue of commands.
+    """
+    in_flight = []
+
+    def fill():
+        while len(in_flight) < limiter.limit:
+            in_flight.append((fake_time.now + latency, limiter.acquire()))
+
+    fill()
+    for _ in range(calls):
+        in_flight.sort(key=lambda call: call[0])
+        end, token = in_flight.pop(0)
+        fake_time.now = max(fake_time.now, end)
+        limiter.release(token, overloaded=overloaded)
+        fill()
+    for end, token in sorted(in_flight, key=lambda call: call[0]):
+        fake_time.now = max(fake_time.now, end)
+        limiter.release(token, overloaded=overloaded)
+
+
+def test_busy_fast_calls_increase_the_limit_up_to_max(fake_time):
+    limiter = AdaptiveConcurrencyLimiter(initial=2, max_limit=6)
+    run_calls(limiter, fake_time, calls=5, latency=0.1)
+    # 每一轮请求（limit 个）约 +1
+    assert limiter.limit == 4
+    run_calls(limiter, fake_time, calls=100, latency=0.1)
+    assert limiter.limit == 6
+
+
+def test_unsaturated_calls_do_not_raise_the_limit(fake_time):
+    limiter = AdaptiveConcurrencyLimiter(initial=4)
+    for _ in range(10):
+        token = limiter.acquire()
+        fake_time.now += 0.1
+        limiter.release(token)
+    assert limiter.limit == 4
+
+
+def test_latency_spike_cuts_the_limit_once_per_round_trip(fake_time):
+    limiter = AdaptiveConcurrencyLimiter(initial=10, max_limit=16, tolerance=2.0, backoff=0.7)
+    token = limiter.acquire()
+    fake_time.now += 0.1
+    limiter.release(token)
+    # 同时进行的 10 个慢请求只降低一次
+    tokens = [limiter.acquire() for _ in range(10)]
+    fake_time.now += 0.5
+    for token in tokens:
+        limiter.release(token)
+    assert limiter.limit == 7
+    # 降低之后发出的慢请求会再次降低
+    tokens = [limiter.acquire() for _ in range(7)]
+    fake_time.now += 0.5
+    for token in tokens:
+        limiter.release(token)
+    assert limiter.limit == 4
+
+
+def test_throttling_backs_off_to_the_floor_and_keeps_the_baseline(fake_time):
+    limiter = AdaptiveConcurrencyLimiter(initial=8, min_limit=2, backoff=0.5)
+    run_calls(limiter, fake_time, calls=8, latency=0.2)
+    baseline = limiter.summary()["baseline_ms"]
+    run_calls(limiter, fake_time, calls=20, latency=0.01, overloaded=True)
+    summary = limiter.summary()
+    assert summary["limit"] == 2
+    # 被拒绝的请求返回得快，不计入基准延迟
+    assert summary["baseline_ms"] == baseline
+    assert summary["throttled"] > 0
+    assert summary["in_flight"] == 0
+
+
+def test_recovers_after_throttling(fake_time):
+    limiter = AdaptiveConcurrencyLimiter(initial=8, min_limit=1, max_limit=8)
+    run_calls(limiter, fake_time, calls=8, latency=0.1)
+    token = limiter.acquire()
+    fake_time.now += 0.01
+    limiter.release(token, overloaded=True)
+    assert limiter.limit == 5
+    run_calls(limiter, fake_time, calls=40, latency=0.1)
+    assert limiter.limit == 8
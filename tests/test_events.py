@@ -0,0 +1,157 @@
+import json
+import socket
+import struct
+import threading
+
+import pytest
+
+from events import DeviceStateTable, EventSubscriber, apply_event
+
+DEVICE = "2E:78:D0:C9:07:8D:78:A0"
+
+# Govee OpenAPI 推送的事件格式
+POWER_EVENT = {
+    "sku": "H7172",
+    "device": DEVICE,
+    "deviceName": "Ice Maker",
+    "capabilities": [
+        {"type": "devices.capabilities.on_off", "instance": "powerSwitch", "state": {"value": 1}},
+        {"type": "devices.capabilities.work_mode", "instance": "workMode",
+         "state": {"value": {"workMode": 2, "modeValue": 0}}},
+    ],
+}
+LACK_WATER_EVENT = {
+    "sku": "H7172",
+    "device": DEVICE,
+    "capabilities": [
+        {"type": "devices.capabilities.event", "instance": "lackWaterEvent",
+         "state": [{"name": "lack", "value": 1, "message": "Lack of Water"}]},
+    ],
+}
+
+
+def test_apply_event_updates_power_and_mode():
+    table = DeviceStateTable()
+    assert apply_event(table, POWER_EVENT) == 2
+    assert table.get(DEVICE, "powerSwitch")["value"] == 1
+    assert table.get(DEVICE, "powerSwitch")["source"] == "event"
+    assert table.get(DEVICE, "workMode")["value"] == {"workMode": 2, "modeValue": 0}
+
+
+def test_apply_event_keeps_event_state_list():
+    table = DeviceStateTable()
+    assert apply_event(table, LACK_WATER_EVENT) == 1
+    assert table.get(DEVICE, "lackWaterEvent")["value"] == [
+        {"name": "lack", "value": 1, "message": "Lack of Water"}]
+
+
+def test_apply_event_ignores_events_without_device():
+    table = DeviceStateTable()
+    assert apply_event(table, {"capabilities": POWER_EVENT["capabilities"]}) == 0
+    assert table.snapshot() == {}
+
+
+def test_handle_message_decodes_payload_and_skips_malformed():
+    table = DeviceStateTable()
+    subscriber = EventSubscriber("key", table)
+    assert subscriber.handle_message(json.dumps(POWER_EVENT).encode("utf-8")) == 2
+    assert subscriber.handle_message(b"{not json") == 0
+    assert table.get(DEVICE, "powerSwitch")["value"] == 1
+
+
+def _read_packet(conn):
+    """One MQTT control packet as (type, body)"""
+    header = conn.recv(1)
+    if not header:
+        return None, b""
+    length, shift = 0, 0
+    while True:
+        byte = conn.recv(1)[0]
+        length += (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    body = b""
+    while len(body) < length:
+        body += conn.recv(length - len(body))
+    return header[0] >> 4, body
+
+
+def _packet(packet_type, body, flags=0):
+    length, encoded = len(body), b""
+    while True:
+        byte, length = length % 128, length // 128
+        encoded += bytes([byte | (0x80 if length else 0)])
+        if not length:
+            break
+    return bytes([packet_type << 4 | flags]) + encoded + body
+
+
+class _BrokerStandIn:
+    """Minimal MQTT 3.1.1 broker: accepts one client and publishes events to its subscription"""
+
+    def __init__(self, events):
+        self.events = events
+        self.credentials = None
+        self.topic = None
+        self._server = socket.socket()
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen(1)
+        self.port = self._server.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        conn, _ = self._server.accept()
+        with conn:
+            while True:
+                packet_type, body = _read_packet(conn)
+                if packet_type is None or packet_type == 14:  # DISCONNECT
+                    return
+                if packet_type == 1:  # CONNECT
+                    self.credentials = body
+                    conn.sendall(_packet(2, b"\x00\x00"))
+                elif packet_type == 8:  # SUBSCRIBE
+                    packet_id = body[:2]
+                    topic_length = struct.unpack("!H", body[2:4])[0]
+                    self.topic = body[4:4 + topic_length].decode("utf-8")
+                    conn.sendall(_packet(9, packet_id + b"\x00"))
+                    for event in self.events:
+                        topic = self.topic.encode("utf-8")
+                        payload = json.dumps(event).encode("utf-8")
+                        conn.sendall(_packet(3, struct.pack("!H", len(topic)) + topic + payload))
+                elif packet_type == 12:  # PINGREQ
+                    conn.sendall(_packet(13, b""))
+
+    def close(self):
+        self._server.close()
+
+
+def test_subscriber_updates_state_table_from_local_broker():
+    pytest.importorskip("paho.mqtt.client")
+    broker = _BrokerStandIn([POWER_EVENT, LACK_WATER_EVENT])
+    table = DeviceStateTable()
+    updated = threading.Event()
+    original_update = table.update
+
+    def update(device_id, instance, value, **kwargs):
+        original_update(device_id, instance, value, **kwargs)
+        if instance == "lackWaterEvent":
+            updated.set()
+
+    table.update = update
+    subscriber = EventSubscriber("test-key", table, host="127.0.0.1", port=broker.port, use_tls=False)
+    subscriber.start()
+    try:
+        assert subscriber.connected.wait(5)
+        assert updated.wait(5)
+    finally:
+        subscriber.stop()
+        broker.close()
+
+    assert broker.topic == "GA/test-key"
+    assert b"test-key" in broker.credentials
+    assert table.get(DEVICE, "powerSwitch")["value"] == 1
+    assert table.get(DEVICE, "powerSwitch")["source"] == "event"
+    assert table.get(DEVICE, "workMode")["value"]["workMode"] == 2
+    assert table.get(DEVICE, "lackWaterEvent")["value"][0]["name"] == "lack"
@@ -0,0 +1,87 @@
+from datetime import datetime
+
+import pytz
+
+from clock import VirtualClock
+from verify import CommandVerifier
+
+
+def _state(value):
+    return {"code": 200, "payload": {"capabilities": [{"instance": "powerSwitch", "state": {"value": value}}]}}
+
+
+def _make_verifier(**kwargs):
+    clock = VirtualClock(pytz.UTC.localize(datetime(2026, 10, 19, 12, 0)), local_timezone="UTC")
+    return clock, CommandVerifier(clock=clock, background=False, **kwargs)
+
+
+def _step(clock, verifier, seconds, steps):
+    for _ in range(steps):
+        clock.advance(seconds)
+        verifier.run_due()
+
+
+def test_confirms_once_the_device_reports_the_value():
+    clock, verifier = _make_verifier(initial_delay=2, factor=2)
+    polls = []
+    reported = {"value": 0}
+
+    def poll(sku, device_id):
+        polls.append(clock.now(pytz.UTC))
+        return _state(reported["value"])
+
+    verifier.expect("H7172", "D1", "powerSwitch", 1, poll, lambda: None)
+    _step(clock, verifier, 1, 6)
+    # 第2秒第一次查询未生效，下一次在 2 + 4 = 第6秒
+    assert [poll_time.second for poll_time in polls] == [2, 6]
+    reported["value"] = 1
+    _step(clock, verifier, 1, 8)
+    assert verifier.summary()["confirmed"] == 1
+    assert verifier.pending() == 0
+    assert [poll_time.second for poll_time in polls] == [2, 6, 14]
+
+
+def test_reissues_then_gives_up():
+    clock, verifier = _make_verifier(initial_delay=1, factor=1, max_polls=2, max_reissues=1)
+    resent = []
+    verifier.expect("H7172", "D1", "powerSwitch", 1, lambda sku, device_id: _state(0),
+                    lambda: resent.append(clock.now(pytz.UTC)))
+    _step(clock, verifier, 1, 10)
+    summary = verifier.summary()
+    assert len(resent) == 1
+    assert summary["reissued"] == 1
+    assert summary["failed"] == 1
+    assert summary["polls"] == 4
+    assert verifier.pending() == 0
+
+
+def test_poll_cap_defers_remaining_devices_to_the_next_round():
+    clock, verifier = _make_verifier(initial_delay=2, max_polls_per_round=2)
+    polled = []
+
+    def poll(sku, device_id):
+        polled.append(device_id)
+        return _state(1)
+
+    for number in range(5):
+        verifier.expect("H7172", f"D{number}", "powerSwitch", 1, poll, lambda: None)
+    clock.advance(2)
+    assert verifier.run_due() == 2
+    # 剩余设备推迟到下一轮，不会立即再查询
+    assert verifier.run_due() == 0
+    clock.advance(2)
+    assert verifier.run_due() == 2
+    clock.advance(2)
+    assert verifier.run_due() == 1
+    assert sorted(polled) == ["D0", "D1", "D2", "D3", "D4"]
+    assert verifier.summary()["confirmed"] == 5
+
+
+def test_throttled_poll_is_retried_later_without_counting():
+    clock, verifier = _make_verifier(initial_delay=2)
+    verifier.expect("H7172", "D1", "powerSwitch", 1,
+                    lambda sku, device_id: {"code": 429, "throttled_locally": True}, lambda: None)
+    clock.advance(2)
+    verifier.run_due()
+    assert verifier.summary()["polls"] == 0
+    assert verifier.pending() == 1